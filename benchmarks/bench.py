@@ -0,0 +1,338 @@
+"""Load tests for the bank, records and faucet services.
+
+Every run seeds a throwaway directory with a database of the requested size,
+then drives each endpoint either through Flask's test client (``--mode
+client``) or through a real gunicorn server with several workers (``--mode
+server``). The records service the bank submits receipts to is replaced by a
+local stand-in, and the faucet uses the stub riddle generator, so nothing
+leaves the machine.
+
+    python benchmarks/bench.py run --accounts 10000 --records 10000 --output before.json
+    python benchmarks/bench.py compare before.json after.json
+
+Rate limits are switched off for the duration of the run. Pass ``--storage
+sqlite`` to run the bank on the SQLite backend instead of the ledger;
+benchmarks/storage_bench.py compares the two backends directly.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+app_dirs = {
+    "bank": os.path.join(root, "src"),
+    "records": os.path.join(root, "records"),
+    "faucet": os.path.join(root, "faucet"),
+}
+bench_password = "bench-password"
+records_password = "bench-records-password"
+
+# Imported by gunicorn in server mode and by the child process in client mode.
+shim = """import os
+import api
+api.limiter.enabled = False
+if os.path.isdir("templates"):
+    api.app.template_folder = os.path.abspath("templates")
+api.warm_up()
+app = api.app
+"""
+
+
+class RecordsStandIn(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        response = json.dumps({"stored": [entry["id"] for entry in body.get("records", [])], "rejected": {}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_records_stand_in():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecordsStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def seed(app, directory, accounts, records):
+    if app == "bank":
+        from argon2 import PasswordHasher
+        # Hashing every account separately would take longer than the run.
+        hashed = PasswordHasher().hash(bench_password)
+        with open(os.path.join(directory, "equacks_database.json"), "w") as f:
+            json.dump({f"user{index}": {"password": hashed, "balance": 1000} for index in range(accounts)}, f)
+        return [f"user{index}" for index in range(accounts)]
+    if app == "records":
+        ids = [secrets.token_urlsafe(32) for index in range(records)]
+        with open(os.path.join(directory, "equacks_record_db.json"), "w") as f:
+            json.dump({record_id: f"user{index} sent user{index + 1} 1 eQuacks on 0 Unix time." for index, record_id in enumerate(ids)}, f)
+        return ids
+    return []
+
+
+def scenarios(app, keys):
+    """Return ``(name, method, path, make_body)`` tuples for an app."""
+    counter = iter(range(10 ** 9))
+    if app == "bank":
+        return [
+            ("create_account", "POST", "/create_account", lambda: {"username": f"new{next(counter)}-{secrets.token_hex(4)}", "password": bench_password}),
+            ("transfer_currency", "POST", "/transfer_currency", lambda: dict(zip(("username", "receiver"), random.sample(keys, 2)), password=bench_password, amount="1")),
+            ("get_balance", "POST", "/get_balance", lambda: {"username": random.choice(keys), "password": bench_password}),
+            ("total_supply", "GET", "/total_supply", None),
+        ]
+    if app == "records":
+        return [
+            ("submit_record", "POST", "/submit_record", lambda: {"password": records_password, "record": "bench sent bench 1 eQuacks on 0 Unix time."}),
+            ("get_record", "GET", lambda: "/get_record/" + random.choice(keys), None),
+        ]
+    return [
+        ("riddle", "GET", "/riddle", None),
+        ("index", "GET", "/", None),
+    ]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    def percentile(fraction):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 3)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+        "throughput_rps": round((len(latencies) + errors) / elapsed, 1) if elapsed else None,
+    }
+
+
+def drive(send, scenario, count, concurrency):
+    name, method, path, make_body = scenario
+    latencies = []
+    errors = 0
+    results_lock = threading.Lock()
+
+    def one(index):
+        nonlocal errors
+        target = path() if callable(path) else path
+        body = make_body() if make_body else None
+        start = time.perf_counter()
+        try:
+            status = send(method, target, body)
+        except Exception:
+            status = None
+        duration = time.perf_counter() - start
+        with results_lock:
+            if status is not None and status < 500:
+                latencies.append(duration)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(count)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def prepare(app, args, records_url):
+    directory = tempfile.mkdtemp(prefix=f"equacks-bench-{app}-")
+    keys = seed(app, directory, args.accounts, args.records)
+    with open(os.path.join(directory, "bench_wsgi.py"), "w") as f:
+        f.write(shim)
+    if app == "faucet":
+        os.makedirs(os.path.join(directory, "templates"), exist_ok=True)
+        with open(os.path.join(app_dirs["faucet"], "index.html"), "r") as source:
+            with open(os.path.join(directory, "templates", "index.html"), "w") as f:
+                f.write(source.read())
+    env = {
+        "records_url": records_url,
+        "record_db_password": records_password,
+        "secret_password": records_password,
+        "faucet_riddle_generator": "stub",
+        "equacks_storage": args.storage,
+        # The shim warms up once the template folder is pointed at the copy.
+        "warm_up": "0",
+    }
+    return directory, keys, env
+
+
+def run_client(app, directory, keys, env, args, queue):
+    # Runs in a fresh process: every app is a module called "api" that sets
+    # itself up from the working directory at import time.
+    os.chdir(directory)
+    os.environ.update(env)
+    sys.path[:0] = [directory, app_dirs[app]]
+    import bench_wsgi
+    local = threading.local()
+
+    def send(method, path, body):
+        if not hasattr(local, "client"):
+            local.client = bench_wsgi.app.test_client()
+        if method == "GET":
+            return local.client.get(path).status_code
+        return local.client.post(path, data=body).status_code
+
+    results = {}
+    for scenario in scenarios(app, keys):
+        results[f"{app}.{scenario[0]}"] = drive(send, scenario, args.requests, args.concurrency)
+    queue.put(results)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_server(app, directory, keys, env, args):
+    import requests
+
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "--threads", str(args.threads), "-b", f"127.0.0.1:{port}", "bench_wsgi:app"],
+        cwd=directory,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join([directory, app_dirs[app]]), **env),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    base = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                requests.get(base + "/ping", timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.time() > deadline or process.poll() is not None:
+                    raise RuntimeError(f"gunicorn did not start for {app}.")
+                time.sleep(0.2)
+
+        local = threading.local()
+
+        def send(method, path, body):
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            if method == "GET":
+                return local.session.get(base + path, timeout=30).status_code
+            return local.session.post(base + path, data=body, timeout=30).status_code
+
+        results = {}
+        for scenario in scenarios(app, keys):
+            results[f"{app}.{scenario[0]}"] = drive(send, scenario, args.requests, args.concurrency)
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run(args):
+    stand_in, records_url = start_records_stand_in()
+    results = {}
+    try:
+        for app in args.apps:
+            directory, keys, env = prepare(app, args, records_url)
+            print(f"Seeded {app} in {directory}", file=sys.stderr)
+            if args.mode == "client":
+                context = multiprocessing.get_context("spawn")
+                queue = context.Queue()
+                process = context.Process(target=run_client, args=(app, directory, keys, env, args, queue))
+                process.start()
+                results.update(queue.get())
+                process.join()
+            else:
+                results.update(run_server(app, directory, keys, env, args))
+            if not args.keep:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        stand_in.shutdown()
+
+    report = {
+        "meta": {
+            "mode": args.mode,
+            "accounts": args.accounts,
+            "records": args.records,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "storage": args.storage,
+            "workers": args.workers if args.mode == "server" else 1,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "time": int(time.time()),
+        },
+        "results": results,
+    }
+    for name, result in results.items():
+        print(f"{name:32} p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms  {result['throughput_rps']} req/s  {result['errors']} errors")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare(args):
+    with open(args.before, "r") as f:
+        before = json.load(f)["results"]
+    with open(args.after, "r") as f:
+        after = json.load(f)["results"]
+
+    def change(old, new):
+        if not old or new is None:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    for name in sorted(set(before) | set(after)):
+        if name not in before or name not in after:
+            print(f"{name:32} only in {'after' if name in after else 'before'}")
+            continue
+        old, new = before[name], after[name]
+        print(f"{name:32} p50 {change(old['p50_ms'], new['p50_ms']):>8}  p99 {change(old['p99_ms'], new['p99_ms']):>8}  throughput {change(old['throughput_rps'], new['throughput_rps']):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--apps", nargs="+", choices=sorted(app_dirs), default=sorted(app_dirs))
+    run_parser.add_argument("--mode", choices=["client", "server"], default="client")
+    run_parser.add_argument("--accounts", type=int, default=1000)
+    run_parser.add_argument("--records", type=int, default=1000)
+    run_parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--workers", type=int, default=4, help="gunicorn workers in server mode")
+    run_parser.add_argument("--threads", type=int, default=4, help="threads per gunicorn worker")
+    run_parser.add_argument("--storage", choices=["ledger", "sqlite"], default="ledger", help="bank storage backend")
+    run_parser.add_argument("--output")
+    run_parser.add_argument("--keep", action="store_true", help="keep the seeded directories")
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
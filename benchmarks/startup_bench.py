@@ -0,0 +1,204 @@
+"""Measure how long a fresh worker takes to become useful.
+
+Each trial starts a new Python process in a seeded directory, the way a
+recycled or newly scaled gunicorn worker starts, and records:
+
+- ``import_ms``: importing the app with the warm-up switched off,
+- ``warm_up_ms``: running ``api.warm_up()``, 0 for cold starts,
+- ``first_ms`` and ``second_ms``: the first and second call to each endpoint,
+- ``boot_ms``: from launching the interpreter to the first response.
+
+Every app is measured both cold and warmed up, and the median of the trials
+is reported. ``--top`` lists the slowest imports of the last trial, as
+reported by ``python -X importtime``.
+
+    python benchmarks/startup_bench.py run --trials 5 --output before.json
+    python benchmarks/startup_bench.py compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench import app_dirs, prepare, start_records_stand_in
+
+marker = "STARTUP_RESULT "
+
+# Runs in the fresh process. The launch time is passed in so the interpreter
+# start-up counts towards boot_ms.
+child = """import json, os, sys, time
+launched, app, warm, keys = float(sys.argv[1]), sys.argv[2], sys.argv[3] == "1", json.loads(sys.argv[4])
+sys.path.insert(0, os.getcwd())
+from bench import scenarios
+start = time.perf_counter()
+import api
+imported = time.perf_counter()
+api.limiter.enabled = False
+if os.path.isdir("templates"):
+    api.app.template_folder = os.path.abspath("templates")
+if warm:
+    api.warm_up()
+ready = time.perf_counter()
+
+client = api.app.test_client()
+def send(method, path, body):
+    if method == "GET":
+        return client.get(path)
+    return client.post(path, data=body)
+
+result = {"import_ms": (imported - start) * 1000, "warm_up_ms": (ready - imported) * 1000, "endpoints": {}}
+for name, method, path, make_body in scenarios(app, keys):
+    timings = []
+    for attempt in range(2):
+        body = make_body() if make_body else None
+        sent = time.perf_counter()
+        send(method, path() if callable(path) else path, body)
+        timings.append((time.perf_counter() - sent) * 1000)
+        if "boot_ms" not in result:
+            result["boot_ms"] = (time.time() - launched) * 1000
+    result["endpoints"][name] = timings
+print(%r + json.dumps(result), flush=True)
+""" % marker
+
+
+def trial(app, directory, keys, env, warm, importtime):
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", child, str(time.time()), app, "1" if warm else "0", json.dumps(keys)]
+    process = subprocess.run(
+        command,
+        cwd=directory,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), app_dirs[app]]), **env),
+        capture_output=True,
+        text=True
+    )
+    lines = [line for line in process.stdout.splitlines() if line.startswith(marker)]
+    if process.returncode != 0 or not lines:
+        raise RuntimeError(f"{app} did not start:\n{process.stderr[-2000:]}")
+    return json.loads(lines[-1][len(marker):]), process.stderr
+
+
+def slowest_imports(stderr, count):
+    # Modules are listed after everything they import, so the app's own
+    # imports are the ones one level deeper that come right before "api".
+    imports = []
+    pending = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = len(name) - len(name.lstrip())
+        if depth == 3:
+            pending.append((int(cumulative) / 1000, name.strip()))
+        elif depth == 1:
+            if name.strip() == "api":
+                imports = pending + [(int(cumulative) / 1000, "api")]
+            pending = []
+    return [{"module": name, "cumulative_ms": round(ms, 1)} for ms, name in sorted(imports, reverse=True)[:count]]
+
+
+def summarize(trials):
+    def median(values):
+        return round(statistics.median(values), 2)
+    summary = {key: median([result[key] for result in trials]) for key in ("import_ms", "warm_up_ms", "boot_ms")}
+    for name in trials[0]["endpoints"]:
+        summary[f"{name}.first_ms"] = median([result["endpoints"][name][0] for result in trials])
+        summary[f"{name}.second_ms"] = median([result["endpoints"][name][1] for result in trials])
+    return summary
+
+
+def run(args):
+    stand_in, records_url = start_records_stand_in()
+    results = {}
+    imports = {}
+    try:
+        for app in args.apps:
+            directory, keys, env = prepare(app, args, records_url)
+            env["warm_up"] = "0"
+            # Keep the keys short; they are passed on the command line.
+            keys = keys[:100]
+            print(f"Seeded {app} in {directory}", file=sys.stderr)
+            for warm in (False, True):
+                trials = []
+                for index in range(args.trials):
+                    result, stderr = trial(app, directory, keys, env, warm, args.top and index == args.trials - 1)
+                    trials.append(result)
+                results[f"{app}.{'warm' if warm else 'cold'}"] = summarize(trials)
+                if args.top and warm:
+                    imports[app] = slowest_imports(stderr, args.top)
+            if not args.keep:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        stand_in.shutdown()
+
+    report = {
+        "meta": {
+            "trials": args.trials,
+            "accounts": args.accounts,
+            "records": args.records,
+            "storage": args.storage,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "time": int(time.time()),
+        },
+        "results": results,
+        "imports": imports,
+    }
+    for name, result in results.items():
+        first = sum(value for key, value in result.items() if key.endswith(".first_ms"))
+        print(f"{name:16} import {result['import_ms']} ms  warm-up {result['warm_up_ms']} ms  first requests {round(first, 2)} ms  boot {result['boot_ms']} ms")
+    for app, slowest in imports.items():
+        print(f"{app} slowest imports: " + ", ".join(f"{entry['module']} {entry['cumulative_ms']} ms" for entry in slowest))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare(args):
+    with open(args.before, "r") as f:
+        before = json.load(f)["results"]
+    with open(args.after, "r") as f:
+        after = json.load(f)["results"]
+
+    for name in sorted(set(before) & set(after)):
+        for key in sorted(set(before[name]) & set(after[name])):
+            old, new = before[name][key], after[name][key]
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{name + '.' + key:48} {old:>10} ms -> {new:>10} ms  {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--apps", nargs="+", choices=sorted(app_dirs), default=sorted(app_dirs))
+    run_parser.add_argument("--trials", type=int, default=5, help="fresh processes per app and mode")
+    run_parser.add_argument("--accounts", type=int, default=1000)
+    run_parser.add_argument("--records", type=int, default=1000)
+    run_parser.add_argument("--storage", choices=["ledger", "sqlite"], default="ledger", help="bank storage backend")
+    run_parser.add_argument("--top", type=int, default=0, help="list this many of the slowest imports")
+    run_parser.add_argument("--output")
+    run_parser.add_argument("--keep", action="store_true", help="keep the seeded directories")
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Compare the bank's storage backends without the web layer in the way.
+
+Seeds each backend with the same accounts, then runs a mix of reads, supply
+lookups and two-account transfers from several processes at once, the way
+gunicorn workers would share one store. Afterwards the supply is checked
+against what it was before, so a lost update shows up as an error.
+
+    python benchmarks/storage_bench.py --accounts 10000 --processes 4 --operations 2000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, "src"))
+
+backends = ["ledger", "sqlite"]
+
+
+def open_backend(kind, directory):
+    from filelock import FileLock
+    from storage import open_storage
+    path = os.path.join(directory, "equacks_database")
+    return open_storage(kind, path, os.path.join(directory, "equacks_database.json"), FileLock(path + ".lock"))
+
+
+def worker(kind, directory, accounts, operations, write_fraction, seed, queue):
+    from locks import AccountLocks
+    storage = open_backend(kind, directory)
+    account_locks = AccountLocks(os.path.join(directory, "equacks_database.locks"))
+    rng = random.Random(seed)
+    latencies = {"get": [], "stats": [], "transfer": []}
+    for index in range(operations):
+        roll = rng.random()
+        start = time.perf_counter()
+        if roll < write_fraction:
+            sender, receiver = rng.sample(range(accounts), 2)
+            sender, receiver = f"user{sender}", f"user{receiver}"
+            with account_locks.hold(sender, receiver):
+                sender_account = storage.get(sender)
+                receiver_account = storage.get(receiver)
+                if sender_account["balance"] >= 1:
+                    storage.commit([
+                        (sender, dict(sender_account, balance=sender_account["balance"] - 1)),
+                        (receiver, dict(receiver_account, balance=receiver_account["balance"] + 1)),
+                    ])
+            latencies["transfer"].append(time.perf_counter() - start)
+        elif roll < write_fraction + 0.05:
+            storage.stats()
+            latencies["stats"].append(time.perf_counter() - start)
+        else:
+            storage.get(f"user{rng.randrange(accounts)}")
+            latencies["get"].append(time.perf_counter() - start)
+    queue.put(latencies)
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    if not latencies:
+        return None
+    return {
+        "operations": len(latencies),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000, 3),
+        "throughput_ops": round(len(latencies) / elapsed, 1),
+    }
+
+
+def bench(kind, args):
+    directory = tempfile.mkdtemp(prefix=f"equacks-storage-{kind}-")
+    try:
+        with open(os.path.join(directory, "equacks_database.json"), "w") as f:
+            json.dump({f"user{index}": {"password": "x" * 97, "balance": 1000} for index in range(args.accounts)}, f)
+
+        start = time.perf_counter()
+        storage = open_backend(kind, directory)
+        import_seconds = time.perf_counter() - start
+        supply = storage.stats()["supply"]
+
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        processes = [
+            context.Process(target=worker, args=(kind, directory, args.accounts, args.operations, args.write_fraction, index, queue))
+            for index in range(args.processes)
+        ]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        collected = {"get": [], "stats": [], "transfer": []}
+        for process in processes:
+            for name, values in queue.get().items():
+                collected[name].extend(values)
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+
+        results = {name: summarize(values, elapsed) for name, values in collected.items()}
+        results["import_seconds"] = round(import_seconds, 3)
+        results["supply_conserved"] = open_backend(kind, directory).stats()["supply"] == supply
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", choices=backends, default=backends)
+    parser.add_argument("--accounts", type=int, default=10000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--operations", type=int, default=2000, help="operations per process")
+    parser.add_argument("--write-fraction", type=float, default=0.2)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    report = {}
+    for kind in args.backends:
+        report[kind] = bench(kind, args)
+        print(f"{kind}: imported {args.accounts} accounts in {report[kind]['import_seconds']} s, supply conserved: {report[kind]['supply_conserved']}")
+        for name in ("get", "stats", "transfer"):
+            result = report[kind][name]
+            if result:
+                print(f"  {name:10} p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms  {result['throughput_ops']} ops/s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if all(result["supply_conserved"] for result in report.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
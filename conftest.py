@@ -0,0 +1,45 @@
+import os
+import sys
+import pytest
+
+root = os.path.dirname(os.path.abspath(__file__))
+services = {os.path.join(root, name) for name in ("src", "records", "faucet")}
+
+
+def service_of(path):
+    """The service directory a test file lives under, such as ``<root>/src``."""
+    relative = os.path.relpath(os.path.abspath(str(path)), root)
+    service = os.path.join(root, relative.split(os.sep)[0])
+    return service if service in services else None
+
+
+def use_service(service):
+    """Make bare imports such as ``import metrics`` find ``service``'s modules.
+
+    Each service imports its modules by bare name, and some names (api,
+    metrics, export, ...) exist in more than one service, so the other
+    services' copies are forgotten first.
+    """
+    for name, module in list(sys.modules.items()):
+        path = os.path.dirname(os.path.abspath(getattr(module, "__file__", None) or ""))
+        if path in services and path != service:
+            del sys.modules[name]
+    if service in sys.path:
+        sys.path.remove(service)
+    sys.path.insert(0, service)
+
+
+def pytest_collectstart(collector):
+    # Before a test module is imported, for its top-level imports.
+    if isinstance(collector, pytest.Module):
+        service = service_of(collector.path)
+        if service is not None:
+            use_service(service)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    # Again before each test and its fixtures, for anything imported lazily.
+    service = service_of(item.path)
+    if service is not None:
+        use_service(service)
@@ -0,0 +1,110 @@
+"""Answer words for new riddles, and matching guesses against answers.
+
+Picking an answer used to mean drawing random words until one got past the
+profanity filter, after loading both word lists at import time. Instead, the
+clean words are filtered once into a plain text file and read the first time
+an answer is needed, after which a pick is a single ``random.choice``:
+
+    python answers.py build
+
+Guesses are compared after ``normalize``: lower case, surrounding
+punctuation stripped, whitespace collapsed. ``accepted_answers`` also takes
+the simple plural forms of the answer, so "Ducks" solves "duck", and
+``is_correct`` also tries the singular of the guess. Only guesses are cut
+down, never the answer, which may be a verb or an adjective: "new" must not
+solve "news". The set is built once when a riddle is rotated in, and
+checking a guess is a set lookup or two.
+"""
+from filelock import FileLock
+import os
+import random
+import re
+import string
+import sys
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+word_list_path = "faucet_answer_words.txt"
+
+
+def build_word_list(path):
+    from wonderwords import RandomWord
+    from better_profanity import profanity
+
+    profanity.load_censor_words()
+    categories = RandomWord(enhanced_prefixes=False).parts_of_speech
+    words = set()
+    for category in ("noun", "verb", "adjective"):
+        words.update(categories[category])
+    clean = [word for word in sorted(words) if "\n" not in word and not profanity.contains_profanity(word)]
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(clean) + "\n")
+    os.replace(temp_path, path)
+    logger.info(f"Wrote {len(clean)} answer words to {path}.")
+    return clean
+
+
+class AnswerWords:
+    def __init__(self, path=word_list_path):
+        self.path = path
+        self.words = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.words is None:
+                # Only one worker builds a missing list; the rest wait and read it.
+                with FileLock(self.path + ".lock"):
+                    if not os.path.exists(self.path):
+                        build_word_list(self.path)
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.words = [line.rstrip("\n") for line in f if line.strip()]
+        return self.words
+
+    def pick(self):
+        return random.choice(self.words if self.words is not None else self.load())
+
+
+def normalize(text):
+    return " ".join(text.lower().split()).strip(string.punctuation + " ")
+
+
+def singular(word):
+    if len(word) > 3 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and re.search(r"(s|x|z|ch|sh)es$", word):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def plurals(word):
+    if re.search(r"[^aeiou]y$", word):
+        return {word[:-1] + "ies"}
+    if re.search(r"(s|x|z|ch|sh)$", word):
+        return {word + "es"}
+    return {word + "s"}
+
+
+def accepted_answers(answer):
+    answer = normalize(answer)
+    return frozenset({answer} | plurals(answer))
+
+
+def is_correct(guess, answers):
+    guess = normalize(guess)
+    return guess in answers or singular(guess) in answers
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    if len(sys.argv) >= 2 and sys.argv[1] == "build":
+        build_word_list(sys.argv[2] if len(sys.argv) > 2 else word_list_path)
+    else:
+        print("Usage: python answers.py build [word list path]")
+        sys.exit(1)
@@ -1,26 +1,34 @@
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, make_response
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from groq import Groq
-from wonderwords import RandomWord
-from better_profanity import profanity
 from markupsafe import escape
 import os
 import json
-import requests
+import hashlib
+import time
+import secrets
+from collections import namedtuple
+from contextlib import contextmanager
 import logging
 from filelock import FileLock, Timeout
+from riddle_pool import RiddlePool, make_generator
+from answers import accepted_answers, is_correct
+from http_client import HTTPClient, never_sent
+import metrics
+import ratelimit  # registers the sqlite:// rate limit storage
 
 lock_path = "riddle.txt.lock"
 riddle_lock = FileLock(lock_path, timeout=20)
 
-profanity.load_censor_words()
 app = Flask(__name__)
-client = Groq(api_key=os.getenv('faucet_secret_groq_api_key'))
-r = RandomWord()
 riddle_path = "riddle.txt"
+riddle_pool_path = "riddle_pool"
+riddle_claims_path = "riddle_claims"
+metrics_path = "faucet_metrics"
+ratelimit_uri = os.environ.get("ratelimit_storage_uri", "sqlite:///faucet_ratelimit.sqlite3")
 faucet_username = os.getenv('faucet_username')
 faucet_password = os.getenv('faucet_password')
+bank_url = os.getenv('bank_url', "https://equacks.pythonanywhere.com")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -36,115 +44,247 @@ def global_key():
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
-    default_limits=[]
+    default_limits=[],
+    storage_uri=ratelimit_uri,
+    strategy="sliding-window-counter"
 )
 
 logger = logging.getLogger(__name__)
+metrics.instrument(app, "faucet", metrics_path)
+
+@contextmanager
+def hold_riddle_lock():
+    start = time.perf_counter()
+    try:
+        riddle_lock.acquire()
+    except Timeout:
+        metrics.increment("lock_timeout")
+        raise
+    acquired = time.perf_counter()
+    metrics.observe("lock_wait", acquired - start)
+    try:
+        yield
+    finally:
+        riddle_lock.release()
+        metrics.observe("lock_hold", time.perf_counter() - acquired)
+
+riddle_pool = RiddlePool(
+    riddle_pool_path,
+    make_generator(os.getenv('faucet_riddle_generator', 'groq'), os.getenv('faucet_secret_groq_api_key')),
+    size=int(os.getenv('faucet_riddle_pool_size', '10'))
+)
+riddle_pool.start_producer()
+
+bank_client = HTTPClient(
+    bank_url,
+    connect_timeout=float(os.getenv('upstream_connect_timeout', '3.05')),
+    read_timeout=float(os.getenv('upstream_read_timeout', '10')),
+    name="bank"
+)
+
+# The riddle on disk changes only when someone wins, so every process keeps a
+# parsed copy and swaps in a new immutable one when riddle.txt is replaced.
+# Rotation always goes through os.replace, so a new inode or mtime is enough
+# to notice it, and page views only cost an os.stat. The accepted forms of the
+# answer are worked out at the same time, so a guess is one set lookup.
+CurrentRiddle = namedtuple("CurrentRiddle", ["riddle", "answer", "answers", "version", "modified"])
+current_riddle = None
+
+def get_current_riddle():
+    global current_riddle
+    try:
+        stat = os.stat(riddle_path)
+    except FileNotFoundError:
+        return None
+    cached = current_riddle
+    if cached is not None and cached.version == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+        return cached
+
+    try:
+        with open(riddle_path, 'r') as f:
+            stat = os.fstat(f.fileno())
+            riddle_data = json.load(f)
+    except FileNotFoundError:
+        return None
+    current_riddle = CurrentRiddle(
+        riddle_data["riddle"],
+        riddle_data["answer"],
+        accepted_answers(riddle_data["answer"]),
+        (stat.st_ino, stat.st_mtime_ns, stat.st_size),
+        int(stat.st_mtime)
+    )
+    return current_riddle
+
+def claim_riddle():
+    """Take the solved riddle down and rotate in the next one.
+
+    The caller must hold the riddle lock. The solved riddle is parked in the
+    claims directory until its reward has been sent, so nobody else can win
+    it and the lock is not held while the bank is called.
+    """
+    claim_path = os.path.join(riddle_claims_path, f"{time.time_ns():020d}-{secrets.token_hex(4)}.json")
+    os.replace(riddle_path, claim_path)
+    if riddle_pool.take(riddle_path) is None:
+        logger.error("Riddle pool was empty when the riddle was solved.")
+    return claim_path
+
+def restore_claim(claim_path):
+    # The reward did not go through, so the solved riddle goes back up as it
+    # was and the one rotated in meanwhile returns to the front of the pool.
+    try:
+        with hold_riddle_lock():
+            if os.path.exists(riddle_path):
+                riddle_pool.put_back(riddle_path)
+            os.replace(claim_path, riddle_path)
+    except Exception as e:
+        logger.error(f"Could not restore the riddle claim '{claim_path}': {e}")
+
+def settle_claim_later(claim_path, username, reason):
+    # The bank may have paid out even though the call failed, so the riddle
+    # must not go back up. Keep the claim out of the requeue and leave it for
+    # someone to check against the bank's history.
+    unsettled_path = claim_path + ".unsettled"
+    try:
+        os.replace(claim_path, unsettled_path)
+    except Exception as e:
+        logger.error(f"Could not set aside the riddle claim '{claim_path}': {e}")
+    logger.error(f"Reward to '{username}' may or may not have been sent because '{reason}'; reconcile '{unsettled_path}' against the bank.")
+
+def requeue_stale_claims(max_age=600):
+    # A worker that died between claiming a riddle and paying for it leaves
+    # the claim behind; give the riddle another go.
+    for name in os.listdir(riddle_claims_path):
+        if name.endswith(".unsettled"):
+            continue
+        path = os.path.join(riddle_claims_path, name)
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                riddle_pool.put_back(path)
+                logger.error(f"Requeued the unpaid riddle claim '{name}'.")
+        except FileNotFoundError:
+            continue
+
+os.makedirs(riddle_claims_path, exist_ok=True)
+requeue_stale_claims()
 
 @app.route('/guess', methods=['POST'])
 @limiter.limit("20 per minute", key_func=global_key)
 @limiter.limit("30 per hour")
 def guess():
-    with riddle_lock:
-        try:
-            if request.is_json:
-                data = request.json
-            else:
-                data = request.form
-            username = data.get('username')
-            guess = data.get('guess')
-
-            if not (isinstance(username, str) and isinstance(guess, str)):
-                return "Both fields must be strings.", 400
-
-            if not os.path.exists(riddle_path):
-                while True:
-                    answer = r.word()
-                    if not profanity.contains_profanity(answer):
-                        break
-
-                completion = client.chat.completions.create(
-                    model="llama-3.1-8b-instant",
-                    messages=[{"role": "user", "content": f"""Create a riddle on '{answer}'. Make a different answer anytime. Make the riddle moderately hard but solvable. When appropriate, you can include ducks in the riddle. Do not make any other comments like 'Here is your riddle' or 'Here you go!'. Only the riddle please."""}]
-                )
-                riddle = completion.choices[0].message.content
-
-                default_riddle = {
-                    "riddle": riddle,
-                    "answer": answer
-                }
-
-
-                temp_path = riddle_path + ".tmp"
-                with open(temp_path, "w") as f:
-                    json.dump(default_riddle, f)
-                os.replace(temp_path, riddle_path)
+    try:
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+        username = data.get('username')
+        guess = data.get('guess')
+
+        if not (isinstance(username, str) and isinstance(guess, str)):
+            return "Both fields must be strings.", 400
+
+        with hold_riddle_lock():
+            riddle_data = get_current_riddle()
+            if riddle_data is None:
+                if riddle_pool.take(riddle_path) is None:
+                    return "No riddle is ready yet, please try again shortly.", 503
                 return "Riddle initialized, please try again.", 409
 
-            with open(riddle_path, 'r') as f:
-                riddle_data = json.load(f)
-
-            if guess.lower() == riddle_data["answer"].lower():
-                payload = {
-                    "username": faucet_username,
-                    "password": faucet_password,
-                    "receiver": username,
-                    "amount": "5"
-                }
-                try:
-                    reward_response = requests.post("https://equacks.pythonanywhere.com/transfer_currency", data=payload)
-                    if not reward_response.status_code == 200:
-                        logger.error(f"'{username}' could not recieve the currency after getting the answer right because '{reward_response.text}'")
-                        return """<p>Reward could not be sent because the username was incorrect or there are internal issues.</p> <a href="https://equacksfaucet.pythonanywhere.com/">Go back to faucet</a>""", 400
-                except Exception as e:
-                    logger.error(f"'{username}' could not recieve the currency after getting the answer right because '{e}'")
-                    return "Could not provide the currency because server could not be contacted.", 500
-
-                while True:
-                    answer = r.word()
-                    if not profanity.contains_profanity(answer):
-                        break
-
-                completion = client.chat.completions.create(
-                    model="llama-3.1-8b-instant",
-                    messages=[{"role": "user", "content": f"""Create a riddle on '{answer}'. Make a different answer anytime. Make the riddle moderately hard but solvable. When appropriate, you can include ducks in the riddle. Do not make any other comments like 'Here is your riddle' or 'Here you go!'. Only the riddle please."""}]
-                )
-                riddle = completion.choices[0].message.content
-
-                default_riddle = {
-                    "riddle": riddle,
-                    "answer": answer
-                }
-
-                temp_path = riddle_path + ".tmp"
-                with open(temp_path, "w") as f:
-                    json.dump(default_riddle, f)
-                os.replace(temp_path, riddle_path)
-                logger.info(f"'{username}' guessed the riddle of '{riddle}' with the answer '{answer}' correctly! The reward was successfully sent to them.")
-                return """<p>Correct answer! Five eQuacks have been sent to the winner.</p><a href="https://equacksfaucet.pythonanywhere.com/">Go back to faucet</a>""", 200
-            else:
+            if not is_correct(guess, riddle_data.answers):
                 return """<p>Wrong answer.</p><a href="https://equacksfaucet.pythonanywhere.com/">Go back to faucet</a>""", 400
+            claim_path = claim_riddle()
+
+        payload = {
+            "username": faucet_username,
+            "password": faucet_password,
+            "receiver": username,
+            "amount": "5"
+        }
+        try:
+            with metrics.timed("upstream_http"):
+                reward_response = bank_client.post("/transfer_currency", data=payload)
+            if reward_response.status_code >= 500:
+                metrics.increment("reward_failure")
+                settle_claim_later(claim_path, username, reward_response.text)
+                return "Could not confirm that the currency was sent, it will be checked by hand.", 500
+            if not reward_response.status_code == 200:
+                metrics.increment("reward_failure")
+                restore_claim(claim_path)
+                logger.error(f"'{username}' could not recieve the currency after getting the answer right because '{reward_response.text}'")
+                return """<p>Reward could not be sent because the username was incorrect or there are internal issues.</p> <a href="https://equacksfaucet.pythonanywhere.com/">Go back to faucet</a>""", 400
+        except Exception as e:
+            metrics.increment("reward_failure")
+            if not never_sent(e):
+                settle_claim_later(claim_path, username, e)
+                return "Could not confirm that the currency was sent, it will be checked by hand.", 500
+            restore_claim(claim_path)
+            logger.error(f"'{username}' could not recieve the currency after getting the answer right because '{e}'")
+            return "Could not provide the currency because server could not be contacted.", 500
+
+        os.remove(claim_path)
+        logger.info(f"'{username}' guessed the riddle of '{riddle_data.riddle}' with the answer '{riddle_data.answer}' correctly! The reward was successfully sent to them.")
+        return """<p>Correct answer! Five eQuacks have been sent to the winner.</p><a href="https://equacksfaucet.pythonanywhere.com/">Go back to faucet</a>""", 200
+    except Exception as e:
+        logger.error(str(e))
+        return "Internal error.", 500
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def metrics_page():
+    try:
+        return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+    except Exception as e:
+        logger.error(str(e))
+        return "Internal error.", 500
+def load_riddle():
+    riddle_data = get_current_riddle()
+    if riddle_data is None:
+        # Only the very first view after a start, or after the pool ran dry,
+        # needs the lock.
+        with hold_riddle_lock():
+            if get_current_riddle() is None:
+                riddle_pool.take(riddle_path)
+        riddle_data = get_current_riddle()
+    return riddle_data
+def warm_up():
+    """Get this worker ready for traffic. Runs at the end of the import unless ``warm_up=0`` is set.
+
+    Parses the current riddle, putting one up from the pool if none is up
+    yet, and compiles the page template. A failure here is logged and left for
+    the first request to run into again.
+    """
+    with metrics.timed("warm_up"):
+        try:
+            load_riddle()
+            app.jinja_env.get_template('index.html')
         except Exception as e:
-            logger.error(str(e))
-            return "Internal error.", 500
+            logger.error("Warm-up failed: " + str(e))
+def conditional_response(riddle_data, body):
+    response = make_response(body)
+    response.headers["Cache-Control"] = "no-cache"
+    if riddle_data is not None:
+        response.set_etag(hashlib.sha256(repr(riddle_data.version).encode()).hexdigest()[:32])
+        response.last_modified = riddle_data.modified
+    return response.make_conditional(request)
 @app.route('/riddle', methods=['GET'])
 @limiter.limit("20 per minute", key_func=global_key)
 def riddle():
-    with riddle_lock:
-        try:
-            with open(riddle_path, 'r') as f:
-                riddle_data = json.load(f)
-            return escape(str(riddle_data["riddle"])), 200
-        except Exception as e:
-            logger.error(str(e))
-            return "Internal error.", 500
+    try:
+        riddle_data = load_riddle()
+        if riddle_data is None:
+            return conditional_response(None, "A new riddle is on its way, check back in a moment.")
+        return conditional_response(riddle_data, escape(str(riddle_data.riddle)))
+    except Exception as e:
+        logger.error(str(e))
+        return "Internal error.", 500
 @app.route('/', methods=['GET'])
 def index():
-    with riddle_lock:
-        try:
-            with open(riddle_path, 'r') as f:
-                riddle_data = json.load(f)
-            return render_template('index.html', riddle = escape(str(riddle_data["riddle"])))
-        except Exception as e:
-            logger.error(str(e))
-            return "Internal error.", 500
+    try:
+        riddle_data = load_riddle()
+        if riddle_data is None:
+            return conditional_response(None, render_template('index.html', riddle = "A new riddle is on its way, check back in a moment."))
+        return conditional_response(riddle_data, render_template('index.html', riddle = escape(str(riddle_data.riddle))))
+    except Exception as e:
+        logger.error(str(e))
+        return "Internal error.", 500
+
+if os.getenv('warm_up', '1') != '0':
+    warm_up()
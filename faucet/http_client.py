@@ -0,0 +1,131 @@
+"""Outbound HTTP to the other eQuacks services.
+
+One ``HTTPClient`` per upstream keeps a pool of keep-alive connections, so
+calls after the first skip the TCP and TLS handshakes, and every call has a
+connect and a read timeout. Failed calls are retried with jittered
+exponential backoff: any failure for idempotent calls, but only failures to
+connect for the rest, since a request that timed out while being read may
+already have been applied. ``never_sent(error)`` tells callers which of the
+two an error was.
+
+A circuit breaker sits in front of each upstream. After
+``failure_threshold`` failures in a row it opens and calls fail at once with
+``CircuitOpen`` for ``reset_after`` seconds; then one trial call is let
+through, which closes the breaker again if it succeeds. ``CircuitOpen`` is a
+``ConnectionError`` and everything requests raises is an ``OSError``, so
+callers can catch ``OSError`` for an unreachable upstream.
+
+requests is only imported when the first call is made, which keeps it off the
+start-up path of workers that rarely talk to the upstream. The same module is
+copied into src/ and faucet/; keep the copies in sync.
+"""
+import random
+import threading
+import time
+import metrics
+
+
+class CircuitOpen(ConnectionError):
+    pass
+
+
+def never_sent(error):
+    """Whether ``error``, raised by a call, means the upstream never got the request.
+
+    True for an open circuit, a connect timeout and a refused connection.
+    Anything else, such as a read timeout or a reset connection, may have
+    come after the upstream acted on the request.
+    """
+    if isinstance(error, CircuitOpen):
+        return True
+    import requests
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+class HTTPClient:
+    def __init__(self, base_url, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.2,
+                 failure_threshold=5, reset_after=30, pool_size=10, name="upstream"):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.name = name
+        self.pool_size = pool_size
+        self.session = None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, idempotent=True, **kwargs)
+
+    def post(self, path, idempotent=False, **kwargs):
+        return self.request("POST", path, idempotent=idempotent, **kwargs)
+
+    def request(self, method, path, idempotent=False, **kwargs):
+        """Send a request and return the response.
+
+        Responses with a 5xx status count as failures for the breaker and are
+        retried when ``idempotent``, but the last one is still returned.
+        """
+        import requests
+
+        kwargs.setdefault("timeout", self.timeout)
+        session = self._session()
+        attempt = 0
+        while True:
+            self._before_call()
+            try:
+                response = session.request(method, self.base_url + path, **kwargs)
+            except requests.RequestException as e:
+                self._after_call(False)
+                retryable = idempotent or never_sent(e)
+                if not retryable or attempt >= self.retries:
+                    raise
+            else:
+                self._after_call(response.status_code < 500)
+                if response.status_code < 500 or not idempotent or attempt >= self.retries:
+                    return response
+            attempt += 1
+            metrics.increment(f"{self.name}_retry")
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _session(self):
+        with self._lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                self.session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                self.session.mount("http://", adapter)
+                self.session.mount("https://", adapter)
+            return self.session
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_after or self._trial_running:
+                metrics.increment(f"{self.name}_circuit_open")
+                raise CircuitOpen(f"Circuit to {self.base_url} is open.")
+            self._trial_running = True
+
+    def _after_call(self, ok):
+        with self._lock:
+            self._trial_running = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
@@ -0,0 +1,158 @@
+"""A queue of ready-made riddles kept on disk.
+
+A background producer keeps ``size`` vetted riddle/answer pairs in the pool
+directory, one JSON file each, so rotating to a new riddle is a rename and the
+LLM is never called while someone is waiting on a request. Only the worker
+holding the producer lock generates, so several gunicorn workers do not fill
+the pool several times over.
+
+Generators are plain objects with a ``generate()`` method returning a
+``{"riddle": ..., "answer": ...}`` dict. ``GroqGenerator`` is the real one;
+``StubGenerator`` needs no network and is meant for local runs and tests.
+"""
+from filelock import FileLock, Timeout
+import json
+import os
+import random
+import secrets
+import threading
+import time
+import logging
+import metrics
+from answers import AnswerWords
+
+logger = logging.getLogger(__name__)
+
+riddle_prompt = """Create a riddle on '{answer}'. Make a different answer anytime. Make the riddle moderately hard but solvable. When appropriate, you can include ducks in the riddle. Do not make any other comments like 'Here is your riddle' or 'Here you go!'. Only the riddle please."""
+
+
+class GroqGenerator:
+    def __init__(self, api_key, model="llama-3.1-8b-instant", words=None):
+        self.api_key = api_key
+        self.model = model
+        self.words = words if words is not None else AnswerWords()
+        self.client = None
+
+    def generate(self):
+        # Both the client and the word list are loaded by the producer thread
+        # on first use, not while the worker is starting.
+        if self.client is None:
+            from groq import Groq
+            self.client = Groq(api_key=self.api_key)
+        answer = self.words.pick()
+
+        completion = self.client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": riddle_prompt.format(answer=answer)}]
+        )
+        return {"riddle": completion.choices[0].message.content, "answer": answer}
+
+
+class StubGenerator:
+    riddles = [
+        ("I have a bill but never pay, I paddle all day in the bay. What am I?", "duck"),
+        ("I fall without getting hurt and fill the pond the ducks love. What am I?", "rain"),
+        ("The more of me you take, the more you leave behind. What am I?", "footsteps"),
+        ("I have keys but open no locks. What am I?", "piano"),
+        ("I can be cracked, made, told and played. What am I?", "joke"),
+    ]
+
+    def generate(self):
+        riddle, answer = random.choice(self.riddles)
+        return {"riddle": riddle, "answer": answer}
+
+
+def make_generator(name, api_key=None):
+    if name == "stub":
+        return StubGenerator()
+    if name == "groq":
+        return GroqGenerator(api_key)
+    raise ValueError(f"Unknown riddle generator '{name}'.")
+
+
+class RiddlePool:
+    def __init__(self, directory, generator, size=10):
+        self.directory = directory
+        self.generator = generator
+        self.size = size
+        self._open_locks()
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries())
+
+    def take(self, destination):
+        """Move the oldest pooled riddle to ``destination``.
+
+        Returns the riddle, or None if the pool is empty. Callers must hold
+        whatever lock guards ``destination``.
+        """
+        for name in self._entries():
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "r") as f:
+                    riddle = json.load(f)
+                os.replace(path, destination)
+            except FileNotFoundError:
+                continue
+            self._wakeup.set()
+            return riddle
+        self._wakeup.set()
+        return None
+
+    def put_back(self, path):
+        """Move a riddle file back to the front of the pool."""
+        os.replace(path, os.path.join(self.directory, f"{0:020d}-{secrets.token_hex(4)}.json"))
+        self._wakeup.set()
+
+    def fill(self):
+        """Generate riddles until the pool is full. Returns how many were added."""
+        added = 0
+        while len(self) < self.size:
+            with metrics.timed("generate"):
+                riddle = self.generator.generate()
+            metrics.increment("riddle_generated")
+            name = f"{time.time_ns():020d}-{secrets.token_hex(4)}.json"
+            temp_path = os.path.join(self.directory, "." + name + ".tmp")
+            with open(temp_path, "w") as f:
+                json.dump(riddle, f)
+            os.replace(temp_path, os.path.join(self.directory, name))
+            added += 1
+        return added
+
+    def start_producer(self, interval=30, max_backoff=600):
+        def run():
+            backoff = interval
+            while True:
+                try:
+                    with self.producer_lock:
+                        added = self.fill()
+                    if added:
+                        logger.info(f"Added {added} riddles to the pool.")
+                    backoff = interval
+                except Timeout:
+                    backoff = interval
+                except Exception as e:
+                    metrics.increment("riddle_generation_failure")
+                    logger.error("Riddle pool could not be refilled: " + str(e))
+                    backoff = min(backoff * 2, max_backoff)
+                self._wakeup.wait(backoff)
+                self._wakeup.clear()
+
+        def restart():
+            # A worker forked from a preloaded app does not inherit the
+            # thread, so it starts its own, with locks of its own too.
+            self._open_locks()
+            threading.Thread(target=run, name="riddle-producer", daemon=True).start()
+
+        thread = threading.Thread(target=run, name="riddle-producer", daemon=True)
+        thread.start()
+        os.register_at_fork(after_in_child=restart)
+        return thread
+
+    def _open_locks(self):
+        self.producer_lock = FileLock(self.directory + ".producer.lock", timeout=0)
+        self._wakeup = threading.Event()
+
+    def _entries(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(".json") and not name.startswith("."))
@@ -1,20 +1,23 @@
-from flask import Flask, request
-import json
+from flask import Flask, Response, request
 import secrets
 import os
-from markupsafe import escape
 import logging
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from filelock import FileLock
+from store import open_store
+from export import format_rows, record_rows
+from handlers import batch_result, check_record, check_records, render_record
+import metrics
+import ratelimit  # registers the sqlite:// rate limit storage
 
 app = Flask(__name__)
-limiter = Limiter(app=app, key_func=get_remote_address)
+ratelimit_uri = os.environ.get("ratelimit_storage_uri", "sqlite:///equacks_records_ratelimit.sqlite3")
+limiter = Limiter(app=app, key_func=get_remote_address, storage_uri=ratelimit_uri, strategy="sliding-window-counter")
 
 admin_password = os.environ.get("secret_password")
 record_db_path = "equacks_record_db.json"
-
-lock = FileLock(record_db_path + ".lock")
+record_store_path = "equacks_records"
+metrics_path = "equacks_metrics"
 
 logging.basicConfig(
     level=logging.INFO,
@@ -26,86 +29,107 @@ logging.basicConfig(
 )
 
 logger = logging.getLogger(__name__)
+metrics.instrument(app, "records", metrics_path)
+
+store = open_store(record_store_path, record_db_path)
+
+def warm_up():
+    """Get this worker ready for traffic. Runs at the end of the import unless ``warm_up=0`` is set."""
+    with metrics.timed("warm_up"):
+        store.warm_up()
 
 @limiter.limit("100 per minute")
 @app.route('/submit_record', methods=["POST"])
 def submit_record():
-    with lock:
-        try:
-            if request.is_json:
-                data = request.json
-            else:
-                data = request.form
-
-            record = data.get('record')
-            password = data.get('password')
-
-            if not isinstance(password, str):
-                return "Password must be string", 400
-
-            if not password == admin_password:
-                return "Invalid password. Please note that only admins should use this.", 400
-
-            if not isinstance(record, str):
-                return "Record must be a string.", 400
+    try:
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
 
-            if len(record) > 200:
-                return "Record is too long.", 400
-
-            if os.path.exists(record_db_path):
-                with open(record_db_path, 'r') as f:
-                    database = json.load(f)
-            else:
-                database = {}
+        error = check_record(data, admin_password)
+        if error is not None:
+            return error
 
+        while True:
             unique_id = str(secrets.token_urlsafe(32))
-            database[unique_id] = record
+            if store.put(unique_id, data.get('record')) == "stored":
+                break
 
-            temp_path = record_db_path + ".tmp"
-            with open(temp_path, "w") as f:
-                json.dump(database, f)
-            os.replace(temp_path, record_db_path)
+        logger.info(f"ID '{unique_id}' successfully recorded.")
+        return unique_id, 200
+    except Exception as e:
+        logger.error(str(e))
+        return "Internal error.", 500
 
-            logger.info(f"ID '{unique_id}' successfully recorded.")
-            return unique_id, 200
-        except Exception as e:
-            logger.error(str(e))
-            return "Internal error.", 500
+@app.route('/submit_records', methods=["POST"])
+@limiter.limit("100 per minute")
+def submit_records():
+    try:
+        error, entries, rejected = check_records(request.get_json(silent=True), admin_password)
+        if error is not None:
+            return error
+
+        result = batch_result(entries, store.put_many(entries), rejected)
+        logger.info(f"{len(result['stored'])} records successfully recorded in one batch.")
+        return result, 200
+    except Exception as e:
+        logger.error(str(e))
+        return "Internal error.", 500
+
+@app.route('/admin/export', methods=["POST"])
+@limiter.limit("10 per minute")
+def admin_export():
+    try:
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+
+        password = data.get('password')
+        output_format = data.get('format', "ndjson")
+
+        if not isinstance(password, str):
+            return "Password must be string", 400
+
+        if not password == admin_password:
+            return "Invalid password. Please note that only admins should use this.", 400
+
+        if output_format not in ("ndjson", "csv"):
+            return "Format must be ndjson or csv.", 400
+
+        def generate():
+            try:
+                yield from format_rows(record_rows(store), output_format)
+            except Exception as e:
+                logger.error("Record export was cut short: " + str(e))
+
+        logger.info("Records exported by an admin.")
+        return Response(generate(), mimetype="text/csv" if output_format == "csv" else "application/x-ndjson", headers={"Cache-Control": "no-store"})
+    except Exception as e:
+        logger.error(str(e))
+        return "Internal error.", 500
+
+@app.route('/metrics', methods=["GET"])
+@limiter.exempt
+def metrics_page():
+    try:
+        return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+    except Exception as e:
+        logger.error(str(e))
+        return "Internal error.", 500
 
 @limiter.limit("10 per minute")
 @app.route('/get_record/<path:subpath>', methods=["GET"])
 def get_record(subpath):
-    if not os.path.exists(record_db_path):
-        return "Record does not exist.", 404
-
-    with lock:
-        with open(record_db_path, 'r') as f:
-            database = json.load(f)
-
     if not isinstance(subpath, str):
         return "Record must be string.", 400
 
-    if not subpath in database:
+    record = store.get(subpath)
+    if record is None:
         return "Record does not exist.", 404
 
-    return f"""
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.7/dist/css/bootstrap.min.css" rel="stylesheet">
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.7/dist/js/bootstrap.bundle.min.js"></script>
-    <style>
-        body {{
-          margin: 0;
-          height: 100vh;
-          display: flex;
-          justify-content: center;
-          align-items: center;
-          flex-direction: column;
-        }}
-
-        p, h1, h2, h3, h4, h5, h6 {{
-          text-align: center;
-          margin: 0.5em 0;
-        }}
-    </style>
-    <h1>eQuacks Record</h1>
-    <h2>{escape(database[subpath])}</h2>
-    """, 200
+    return render_record(record), 200
+
+if os.environ.get("warm_up", "1") != "0":
+    warm_up()
@@ -0,0 +1,362 @@
+"""ASGI front end for the records service.
+
+Serves the same routes as api.py from an event loop, for when receipt links
+draw more readers than a pool of synchronous workers can hold open:
+
+    uvicorn asgi:app --workers 4
+
+Record pages never change once stored, so rendered pages are kept in an
+in-process LRU cache and a cached read does no store lookup at all. Writes
+from every connection are handed to one committer task, which stores
+whatever has queued up since its last commit with a single ``put_many``
+(one append and one fsync) on a worker thread while the loop keeps serving.
+
+The store is read in during the lifespan start-up, before the server takes
+traffic. Checks, messages and pages come from handlers.py, which api.py uses
+too.
+Form bodies must be URL-encoded; multipart forms are not parsed.
+"""
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import SlidingWindowCounterRateLimiter
+from export import format_rows, record_rows
+from handlers import batch_result, check_record, check_records, render_record
+from store import open_store
+import metrics
+import ratelimit  # registers the sqlite:// rate limit storage
+
+admin_password = os.environ.get("secret_password")
+record_db_path = "equacks_record_db.json"
+record_store_path = "equacks_records"
+metrics_path = "equacks_metrics"
+ratelimit_uri = os.environ.get("ratelimit_storage_uri", "sqlite:///equacks_records_ratelimit.sqlite3")
+page_cache_size = int(os.environ.get("records_page_cache_size", "10000"))
+max_body_size = 4 * 1024 * 1024
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[
+        logging.FileHandler("app.log"),
+        logging.StreamHandler()
+    ]
+)
+
+logger = logging.getLogger(__name__)
+metrics.share("records", metrics_path)
+
+store = open_store(record_store_path, record_db_path)
+rate_limiter = SlidingWindowCounterRateLimiter(storage_from_string(ratelimit_uri))
+limits = {
+    "submit_records": parse("100 per minute"),
+    "admin_export": parse("10 per minute"),
+}
+
+
+class PageCache:
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+
+    def get(self, record_id):
+        page = self.pages.get(record_id)
+        if page is not None:
+            self.pages.move_to_end(record_id)
+        return page
+
+    def put(self, record_id, page):
+        self.pages[record_id] = page
+        if len(self.pages) > self.size:
+            self.pages.popitem(last=False)
+
+
+class GroupCommit:
+    def __init__(self, store, max_entries=1000):
+        self.store = store
+        self.max_entries = max_entries
+        self.queue = None
+        self.task = None
+
+    async def put_many(self, entries):
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((entries, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            group = [await self.queue.get()]
+            count = len(group[0][0])
+            while count < self.max_entries and not self.queue.empty():
+                group.append(self.queue.get_nowait())
+                count += len(group[-1][0])
+
+            entries = [entry for item, future in group for entry in item]
+            try:
+                results = await loop.run_in_executor(None, self.store.put_many, entries)
+            except Exception as e:
+                for item, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            metrics.increment("group_commit", endpoint="background")
+            metrics.increment("group_commit_entries", len(entries), endpoint="background")
+
+            position = 0
+            for item, future in group:
+                if not future.done():
+                    future.set_result(results[position:position + len(item)])
+                position += len(item)
+
+
+page_cache = PageCache(page_cache_size)
+committer = GroupCommit(store)
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        self.mimetype = headers.get("content-type", "").split(";")[0].strip().lower()
+        self.remote_address = scope["client"][0] if scope.get("client") else "127.0.0.1"
+
+    @property
+    def is_json(self):
+        return self.mimetype == "application/json" or (self.mimetype.startswith("application/") and self.mimetype.endswith("+json"))
+
+    def data(self):
+        # The same choice api.py makes between request.json and request.form.
+        if self.is_json:
+            return json.loads(self.body)
+        if self.mimetype == "application/x-www-form-urlencoded":
+            return dict(reversed(parse_qsl(self.body.decode("utf-8"), keep_blank_values=True)))
+        return {}
+
+    def json(self):
+        if not self.is_json:
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+def response(body, status=200, content_type="text/html; charset=utf-8", headers=None):
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body, sort_keys=True, separators=(",", ":")) + "\n"
+        content_type = "application/json"
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return status, body, content_type, headers or {}
+
+
+def read_block(chunks, size=64 * 1024):
+    """Join text chunks from the ``chunks`` iterator until about ``size`` bytes."""
+    block = []
+    length = 0
+    for chunk in chunks:
+        block.append(chunk.encode("utf-8"))
+        length += len(block[-1])
+        if length >= size:
+            break
+    return b"".join(block)
+
+
+async def rate_limited(endpoint, request):
+    # The counters live in SQLite, so they are checked off the event loop.
+    loop = asyncio.get_running_loop()
+    return not await loop.run_in_executor(None, rate_limiter.hit, limits[endpoint], endpoint, request.remote_address)
+
+
+async def get_record(request, subpath):
+    page = page_cache.get(subpath)
+    if page is None:
+        record = store.get(subpath)
+        if record is None:
+            return response("Record does not exist.", 404)
+        page = render_record(record).encode("utf-8")
+        page_cache.put(subpath, page)
+    return response(page)
+
+
+async def submit_record(request):
+    try:
+        data = request.data()
+
+        error = check_record(data, admin_password)
+        if error is not None:
+            return response(*error)
+
+        while True:
+            unique_id = str(secrets.token_urlsafe(32))
+            if (await committer.put_many([(unique_id, data.get('record'))]))[0] == "stored":
+                break
+
+        logger.info(f"ID '{unique_id}' successfully recorded.")
+        return response(unique_id)
+    except Exception as e:
+        logger.error(str(e))
+        return response("Internal error.", 500)
+
+
+async def submit_records(request):
+    try:
+        error, entries, rejected = check_records(request.json(), admin_password)
+        if error is not None:
+            return response(*error)
+
+        result = batch_result(entries, await committer.put_many(entries), rejected)
+        logger.info(f"{len(result['stored'])} records successfully recorded in one batch.")
+        return response(result)
+    except Exception as e:
+        logger.error(str(e))
+        return response("Internal error.", 500)
+
+
+async def admin_export(scope, receive, send, request):
+    try:
+        data = request.data()
+        password = data.get('password')
+        output_format = data.get('format', "ndjson")
+
+        if not isinstance(password, str):
+            return response("Password must be string", 400)
+
+        if not password == admin_password:
+            return response("Invalid password. Please note that only admins should use this.", 400)
+
+        if output_format not in ("ndjson", "csv"):
+            return response("Format must be ndjson or csv.", 400)
+
+        logger.info("Records exported by an admin.")
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/csv; charset=utf-8" if output_format == "csv" else b"application/x-ndjson"),
+                (b"cache-control", b"no-store"),
+            ],
+        })
+        try:
+            # Scanning the segments is blocking file work, so it runs on a
+            # worker thread a block at a time while the loop keeps serving.
+            loop = asyncio.get_running_loop()
+            chunks = format_rows(record_rows(store), output_format)
+            while True:
+                block = await loop.run_in_executor(None, read_block, chunks)
+                if not block:
+                    break
+                await send({"type": "http.response.body", "body": block, "more_body": True})
+        except Exception as e:
+            logger.error("Record export was cut short: " + str(e))
+        await send({"type": "http.response.body", "body": b""})
+        return None
+    except Exception as e:
+        logger.error(str(e))
+        return response("Internal error.", 500)
+
+
+async def metrics_page(request):
+    try:
+        return response(metrics.render(), content_type="text/plain; version=0.0.4")
+    except Exception as e:
+        logger.error(str(e))
+        return response("Internal error.", 500)
+
+
+async def read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        size += len(chunks[-1])
+        if size > max_body_size:
+            return None
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def dispatch(scope, receive, send):
+    method = scope["method"]
+    path = scope["path"]
+
+    if path.startswith("/get_record/") and len(path) > len("/get_record/"):
+        if method not in ("GET", "HEAD"):
+            return "get_record", response("Method Not Allowed", 405)
+        return "get_record", await get_record(Request(scope, b""), path[len("/get_record/"):])
+
+    routes = {
+        "/submit_record": ("submit_record", "POST"),
+        "/submit_records": ("submit_records", "POST"),
+        "/admin/export": ("admin_export", "POST"),
+        "/metrics": ("metrics_page", "GET"),
+    }
+    if path not in routes:
+        return "unknown", response("Not Found", 404)
+    endpoint, allowed = routes[path]
+    if method != allowed:
+        return endpoint, response("Method Not Allowed", 405)
+
+    body = await read_body(receive) if method == "POST" else b""
+    if body is None:
+        return endpoint, response("Request Entity Too Large", 413)
+    request = Request(scope, body)
+
+    if endpoint in limits and await rate_limited(endpoint, request):
+        return endpoint, response("Too Many Requests", 429)
+    if endpoint == "submit_record":
+        return endpoint, await submit_record(request)
+    if endpoint == "submit_records":
+        return endpoint, await submit_records(request)
+    if endpoint == "admin_export":
+        return endpoint, await admin_export(scope, receive, send, request)
+    return endpoint, await metrics_page(request)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            with metrics.timed("warm_up"):
+                store.warm_up()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    start = time.perf_counter()
+    endpoint, result = await dispatch(scope, receive, send)
+    if result is not None:
+        status, body, content_type, headers = result
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode("latin-1")),
+                (b"content-length", str(len(body)).encode("latin-1")),
+            ] + [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()],
+        })
+        await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+    metrics.observe("request", time.perf_counter() - start, endpoint=endpoint)
@@ -0,0 +1,61 @@
+"""Stream every record out as NDJSON or CSV in bounded memory.
+
+    python export.py --format csv --output records.csv
+    python export.py --legacy equacks_record_db.json
+
+Rows are ``{"id": ..., "record": ...}`` and come from the record store's
+segments in the order they were written. With ``--legacy`` they come straight
+from an old JSON database, parsed one record at a time.
+"""
+import argparse
+import os
+import sys
+from store import RecordStore
+from streaming import csv_lines, iter_object, ndjson_lines
+
+record_fields = ["id", "record"]
+
+
+def legacy_records(json_path):
+    with open(json_path, "r", encoding="utf-8") as f:
+        yield from iter_object(f)
+
+
+def record_rows(records):
+    for record_id, record in records:
+        yield {"id": record_id, "record": record}
+
+
+def format_rows(rows, output_format):
+    if output_format == "csv":
+        return csv_lines(rows, record_fields)
+    return ndjson_lines(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", default="equacks_records", help="record store path")
+    parser.add_argument("--legacy", help="read records from an old JSON database instead")
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--output", help="file to write to instead of stdout")
+    args = parser.parse_args()
+
+    if args.legacy:
+        records = legacy_records(args.legacy)
+    else:
+        store = RecordStore(args.store)
+        if not os.path.exists(store.index_path):
+            parser.error(f"There is no record store at {args.store}.")
+        records = iter(store)
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        for line in format_rows(record_rows(records), args.format):
+            output.write(line)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Request handling shared by the Flask app (api.py) and the ASGI app (asgi.py).
+
+Both front ends parse the request their own way and then hand the data to
+these functions, so the checks, messages and pages stay the same whichever
+one is serving.
+"""
+import re
+from markupsafe import escape
+
+record_id_pattern = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+record_page = """
+    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.7/dist/css/bootstrap.min.css" rel="stylesheet">
+    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.7/dist/js/bootstrap.bundle.min.js"></script>
+    <style>
+        body {{
+          margin: 0;
+          height: 100vh;
+          display: flex;
+          justify-content: center;
+          align-items: center;
+          flex-direction: column;
+        }}
+
+        p, h1, h2, h3, h4, h5, h6 {{
+          text-align: center;
+          margin: 0.5em 0;
+        }}
+    </style>
+    <h1>eQuacks Record</h1>
+    <h2>{record}</h2>
+    """
+
+
+def render_record(record):
+    return record_page.format(record=escape(record))
+
+
+def check_record(data, admin_password):
+    """Return an ``(error, status)`` pair for a bad /submit_record body, or None."""
+    record = data.get('record')
+    password = data.get('password')
+
+    if not isinstance(password, str):
+        return "Password must be string", 400
+
+    if not password == admin_password:
+        return "Invalid password. Please note that only admins should use this.", 400
+
+    if not isinstance(record, str):
+        return "Record must be a string.", 400
+
+    if len(record) > 200:
+        return "Record is too long.", 400
+
+    return None
+
+
+def check_records(data, admin_password):
+    """Validate a /submit_records body.
+
+    Returns ``(error, entries, rejected)``. ``error`` is an ``(error,
+    status)`` pair when the whole batch is refused, otherwise ``entries``
+    holds the ``(id, record)`` pairs to store and ``rejected`` maps the IDs
+    that were skipped to the reason.
+    """
+    if not isinstance(data, dict):
+        return ("Body must be a JSON object.", 400), None, None
+
+    records = data.get('records')
+    password = data.get('password')
+
+    if not isinstance(password, str):
+        return ("Password must be string", 400), None, None
+
+    if not password == admin_password:
+        return ("Invalid password. Please note that only admins should use this.", 400), None, None
+
+    if not isinstance(records, list):
+        return ("Records must be a list.", 400), None, None
+
+    if len(records) > 1000:
+        return ("Too many records in one batch.", 400), None, None
+
+    entries = []
+    rejected = {}
+    for entry in records:
+        if not isinstance(entry, dict):
+            return ("Each record must be an object.", 400), None, None
+        unique_id = entry.get('id')
+        record = entry.get('record')
+
+        if not isinstance(unique_id, str) or not record_id_pattern.fullmatch(unique_id):
+            return ("Record ID must be a URL-safe string of at most 64 characters.", 400), None, None
+        if not isinstance(record, str):
+            rejected[unique_id] = "Record must be a string."
+            continue
+        if len(record) > 200:
+            rejected[unique_id] = "Record is too long."
+            continue
+        entries.append((unique_id, record))
+    return None, entries, rejected
+
+
+def batch_result(entries, results, rejected):
+    stored = []
+    # Batches are retried after failures, so the same ID and record
+    # arriving twice is expected and not an error.
+    for (unique_id, record), result in zip(entries, results):
+        if result == "taken":
+            rejected[unique_id] = "Record ID is already taken."
+        else:
+            stored.append(unique_id)
+    return {"stored": stored, "rejected": rejected}
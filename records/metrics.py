@@ -0,0 +1,205 @@
+"""Per-phase timings and event counters, exposed in Prometheus text format.
+
+``timed("phase")`` records how long a block took against the endpoint of the
+current request, and ``increment("event")`` bumps a counter. Recording is a
+dict lookup and a few integer additions under a lock, so it is cheap enough to
+leave on the request path.
+
+Gunicorn workers do not share memory, so each process writes its numbers to
+``<directory>/<pid>.json`` every few seconds and ``render()`` adds up the
+files of the processes that are still running. A process removes its file
+when it exits, and ``render()`` deletes any left behind by one that was
+killed, so restarts do not pile up files or keep counting dead workers. The
+same module is copied into src/, records/ and faucet/, which are deployed
+separately; keep the copies in sync.
+"""
+from contextlib import contextmanager
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+import logging
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+app_name = "equacks"
+directory = None
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+def current_endpoint():
+    try:
+        from flask import has_request_context, request
+        if has_request_context():
+            return request.endpoint or "unknown"
+    except ImportError:
+        pass
+    return "background"
+
+
+def observe(phase, seconds, endpoint=None):
+    key = (endpoint or current_endpoint(), phase)
+    index = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[index] += 1
+        histogram[-1] += seconds
+
+
+def increment(event, amount=1, endpoint=None):
+    key = (endpoint or current_endpoint(), event)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - start)
+
+
+def share(name, metrics_directory=None):
+    """Name this app's metrics and start sharing numbers between workers."""
+    global app_name, directory
+    app_name = name
+    directory = metrics_directory
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=_export_forever, name="metrics-exporter", daemon=True).start()
+        atexit.register(_remove_export)
+        os.register_at_fork(after_in_child=_after_fork)
+
+
+def instrument(app, name, metrics_directory=None):
+    """Time every request of the Flask ``app`` and share the numbers."""
+    from flask import g
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.teardown_request
+    def stop_timer(exception=None):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            observe("request", time.perf_counter() - start)
+
+    share(name, metrics_directory)
+
+
+def snapshot():
+    with _lock:
+        return {
+            "histograms": [[endpoint, phase, list(values)] for (endpoint, phase), values in _histograms.items()],
+            "counters": [[endpoint, event, value] for (endpoint, event), value in _counters.items()],
+        }
+
+
+def render():
+    histograms = {}
+    counters = {}
+    for data in _collect():
+        for endpoint, phase, values in data["histograms"]:
+            total = histograms.setdefault((endpoint, phase), [0] * (len(BUCKETS) + 1) + [0.0])
+            for index, value in enumerate(values):
+                total[index] += value
+        for endpoint, event, value in data["counters"]:
+            counters[(endpoint, event)] = counters.get((endpoint, event), 0) + value
+
+    lines = [
+        "# HELP equacks_phase_seconds Time spent in each phase of handling a request.",
+        "# TYPE equacks_phase_seconds histogram",
+    ]
+    for (endpoint, phase), values in sorted(histograms.items()):
+        labels = f'app="{app_name}",endpoint="{endpoint}",phase="{phase}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), values):
+            cumulative += count
+            lines.append(f'equacks_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"equacks_phase_seconds_sum{{{labels}}} {values[-1]}")
+        lines.append(f"equacks_phase_seconds_count{{{labels}}} {cumulative}")
+
+    lines.append("# HELP equacks_events_total Count of notable events such as lock timeouts.")
+    lines.append("# TYPE equacks_events_total counter")
+    for (endpoint, event), value in sorted(counters.items()):
+        lines.append(f'equacks_events_total{{app="{app_name}",endpoint="{endpoint}",event="{event}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def _collect():
+    own = snapshot()
+    if directory is None:
+        return [own]
+    collected = [own]
+    own_name = f"{os.getpid()}.json"
+    for name in os.listdir(directory):
+        pid = name.split(".")[0]
+        if name == own_name or not pid.isdigit():
+            continue
+        path = os.path.join(directory, name)
+        if not _alive(int(pid)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(path, "r") as f:
+                collected.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return collected
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove_export():
+    try:
+        os.remove(os.path.join(directory, f"{os.getpid()}.json"))
+    except OSError:
+        pass
+
+
+def _after_fork():
+    # A worker forked from a preloaded app starts with a copy of the parent's
+    # numbers, which the parent already exports, and without the exporter
+    # thread. Start from zero with a thread of its own.
+    global _lock
+    _lock = threading.Lock()
+    _histograms.clear()
+    _counters.clear()
+    threading.Thread(target=_export_forever, name="metrics-exporter", daemon=True).start()
+
+
+def _export_forever(interval=5):
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    while True:
+        time.sleep(interval)
+        try:
+            temp_path = path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(snapshot(), f)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logger.error("Could not export metrics: " + str(e))
@@ -0,0 +1,147 @@
+"""Rate limit counters shared by every worker process on a host.
+
+Flask-Limiter's default storage lives in the memory of one process, so with
+several gunicorn workers each one enforces the full limit on its own.
+Importing this module registers a ``sqlite://`` storage with the ``limits``
+package that keeps the counters in one small SQLite database instead:
+
+    Limiter(app=app, storage_uri="sqlite:///equacks_ratelimit.sqlite3",
+            strategy="sliding-window-counter")
+
+A sliding window hit is one ``BEGIN IMMEDIATE`` transaction that reads the
+previous and current window and bumps the current one only if the weighted
+count allows it, so two workers cannot both take the last slot. The
+database runs in WAL mode with ``synchronous = OFF``: a counter lost in a
+power cut only loosens one window, which is not worth an fsync per request.
+The same module is copied into src/, records/ and faucet/; keep the copies
+in sync.
+"""
+from math import floor
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from limits.storage import SlidingWindowCounterSupport, Storage
+
+schema = """
+CREATE TABLE IF NOT EXISTS counters (
+    key TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS counters_expires ON counters (expires);
+"""
+
+
+class SQLiteLimiterStorage(Storage, SlidingWindowCounterSupport):
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri, wrap_exceptions=False, timeout=5, cleanup_every=1000, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        # sqlite:///relative/path and sqlite:////absolute/path, as elsewhere.
+        self.path = uri[len("sqlite:///"):]
+        self.timeout = timeout
+        self.cleanup_every = cleanup_every
+        self._local = threading.local()
+        self._writes = itertools.count(1)
+        self._connection().executescript(schema)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _write(self, work):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(connection, time.time())
+            if next(self._writes) % self.cleanup_every == 0:
+                connection.execute("DELETE FROM counters WHERE expires <= ?", (time.time(),))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return result
+
+    def _count(self, connection, key, now):
+        row = connection.execute("SELECT count FROM counters WHERE key = ? AND expires > ?", (key, now)).fetchone()
+        return row[0] if row else 0
+
+    def _add(self, connection, key, expiry, amount, now):
+        row = connection.execute("SELECT count, expires FROM counters WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= now:
+            count, expires = amount, now + expiry
+        else:
+            count, expires = row[0] + amount, row[1]
+        connection.execute("INSERT OR REPLACE INTO counters (key, count, expires) VALUES (?, ?, ?)", (key, count, expires))
+        return count
+
+    def incr(self, key, expiry, amount=1):
+        return self._write(lambda connection, now: self._add(connection, key, expiry, amount, now))
+
+    def get(self, key):
+        return self._count(self._connection(), key, time.time())
+
+    def get_expiry(self, key):
+        row = self._connection().execute("SELECT expires FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            self._connection().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self._write(lambda connection, now: connection.execute("DELETE FROM counters").rowcount)
+
+    def clear(self, key):
+        self._write(lambda connection, now: connection.execute("DELETE FROM counters WHERE key = ?", (key,)))
+
+    def _window(self, connection, key, expiry, now):
+        window = int(now // expiry)
+        previous_key = f"{key}/{window - 1}"
+        current_key = f"{key}/{window}"
+        previous_count = self._count(connection, previous_key, now)
+        # How much longer the previous window still counts for.
+        previous_ttl = expiry - now % expiry if previous_count else 0.0
+        current_count = self._count(connection, current_key, now)
+        current_ttl = 2 * expiry - now % expiry
+        return current_key, previous_count, previous_ttl, current_count, current_ttl
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+
+        def acquire(connection, now):
+            current_key, previous_count, previous_ttl, current_count, current_ttl = self._window(connection, key, expiry, now)
+            if floor(previous_count * previous_ttl / expiry + current_count) + amount > limit:
+                return False
+            # The current window keeps counting, weighted down, through the
+            # next one, so it has to outlive it.
+            self._add(connection, current_key, current_ttl, amount, now)
+            return True
+
+        return self._write(acquire)
+
+    def get_sliding_window(self, key, expiry):
+        connection = self._connection()
+        current_key, previous_count, previous_ttl, current_count, current_ttl = self._window(connection, key, expiry, time.time())
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    def clear_sliding_window(self, key, expiry):
+        window = int(time.time() // expiry)
+        self.clear(f"{key}/{window - 1}")
+        self.clear(f"{key}/{window}")
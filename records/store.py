@@ -0,0 +1,369 @@
+"""Append-only record store with an on-disk hash index.
+
+Records are appended to segment files (``<path>.segments/000001.seg``, ...)
+that roll over once they reach ``segment_size`` bytes and are never rewritten.
+``<path>.idx`` is an open-addressing hash table mapping each record ID to the
+segment, offset and length of its entry.
+
+Both files are read through ``mmap``, so looking a record up is a hash, a
+probe or two and a slice, with no lock and no parsing of anything else. Writers
+take a FileLock, fsync the segment before touching the index, and write each
+index slot with a checksum. A reader that meets a half-written slot treats it
+as the end of the probe chain, which is exactly where a new key would go. When
+the table gets too full it is rebuilt at double the size and swapped in with a
+rename; readers notice the new file the next time a lookup misses.
+
+Run ``python store.py import equacks_record_db.json`` once to move the old JSON
+database over.
+"""
+from filelock import FileLock
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+import logging
+import metrics
+from streaming import iter_object
+
+HEADER = struct.Struct("<8sQQ")
+MAGIC = b"EQRIDX1\0"
+# id length (0 means empty), id, segment, offset, length, crc32
+SLOT = struct.Struct("<B64sIQHI")
+SLOT_BODY = struct.Struct("<B64sIQH")
+ENTRY_HEADER = struct.Struct("<BH")
+
+logger = logging.getLogger(__name__)
+
+
+class StoreError(Exception):
+    pass
+
+
+def key_hash(record_id):
+    return int.from_bytes(hashlib.blake2b(record_id, digest_size=8).digest(), "little")
+
+
+def pack_slot(record_id, segment, offset, length):
+    body = SLOT_BODY.pack(len(record_id), record_id, segment, offset, length)
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def unpack_slot(data):
+    id_len, record_id, segment, offset, length, crc = SLOT.unpack(data)
+    if id_len == 0:
+        return None
+    if zlib.crc32(data[:SLOT_BODY.size]) != crc:
+        raise ValueError("torn slot")
+    return record_id[:id_len], segment, offset, length
+
+
+class RecordStore:
+    def __init__(self, path, segment_size=64 * 1024 * 1024, initial_capacity=4096):
+        self.index_path = path + ".idx"
+        self.segment_dir = path + ".segments"
+        self.segment_size = segment_size
+        self.initial_capacity = initial_capacity
+        self.lock = FileLock(path + ".lock")
+        self._map_lock = threading.Lock()
+        # (mmap, capacity, inode), swapped as one object so a lookup never
+        # probes one table with the other's size.
+        self._table = None
+        self._segments = {}
+
+    def open(self):
+        os.makedirs(self.segment_dir, exist_ok=True)
+        with self.lock:
+            if not os.path.exists(self.index_path):
+                self._write_table(self.index_path, self.initial_capacity, [])
+            self._repair_tail()
+        self._map_index()
+
+    def get(self, record_id):
+        with metrics.timed("db_load"):
+            key = record_id.encode("utf-8")
+            if len(key) > 64:
+                return None
+            location = self._lookup(key)
+            if location is None:
+                with self._map_lock:
+                    self._refresh_index()
+                location = self._lookup(key)
+                if location is None:
+                    return None
+            return self._read_entry(*location)[1]
+
+    def put(self, record_id, record):
+        return self.put_many([(record_id, record)])[0]
+
+    def put_many(self, entries):
+        """Store ``(record_id, record)`` pairs with one append and one fsync.
+
+        Returns one status per entry: "stored", "exists" when the same record
+        is already there, or "taken" when the ID holds a different record.
+        """
+        start = time.perf_counter()
+        with self.lock, metrics.timed("db_write"):
+            metrics.observe("lock_wait", time.perf_counter() - start)
+            self._refresh_index()
+            results = [None] * len(entries)
+            pending = {}
+            for position, (record_id, record) in enumerate(entries):
+                key = record_id.encode("utf-8")
+                if len(key) > 64:
+                    raise StoreError("Record ID is too long.")
+                location = self._lookup(key)
+                if location is not None:
+                    existing = self._read_entry(*location)[1]
+                    results[position] = "exists" if existing == record else "taken"
+                elif key in pending:
+                    results[position] = "exists" if pending[key][1] == record else "taken"
+                else:
+                    pending[key] = (position, record)
+
+            if pending:
+                locations = self._append(list(pending.items()))
+                with open(self.index_path, "rb") as f:
+                    capacity, count = self._read_header(f)
+                if (count + len(locations)) * 10 > capacity * 7:
+                    self._grow(count + len(locations))
+                with open(self.index_path, "r+b") as f:
+                    capacity, count = self._read_header(f)
+                    for key, segment, offset, length in locations:
+                        self._insert(f, capacity, key, segment, offset, length)
+                    f.seek(0)
+                    f.write(HEADER.pack(MAGIC, capacity, count + len(locations)))
+                    f.flush()
+                    os.fsync(f.fileno())
+                for key, (position, record) in pending.items():
+                    results[position] = "stored"
+            return results
+
+    def warm_up(self):
+        """Read the index and the newest segment in ahead of the first lookups.
+
+        Fresh receipts are the ones people open, so the newest segment is
+        mapped now too instead of by the first reader that needs it.
+        """
+        names = sorted(name for name in os.listdir(self.segment_dir) if name.endswith(".seg"))
+        if names:
+            segment = int(names[-1].split(".")[0])
+            with open(self._segment_path(segment), "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    with self._map_lock:
+                        self._segments[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        views = [self._table[0]] + list(self._segments.values())
+        if hasattr(mmap, "MADV_WILLNEED"):
+            for view in views:
+                view.madvise(mmap.MADV_WILLNEED)
+
+    def __iter__(self):
+        for name in sorted(name for name in os.listdir(self.segment_dir) if name.endswith(".seg")):
+            for record_id, record, end in self._scan(os.path.join(self.segment_dir, name)):
+                yield record_id, record
+
+    def _scan(self, path):
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = 0
+        while offset + ENTRY_HEADER.size <= len(data):
+            id_len, record_len = ENTRY_HEADER.unpack_from(data, offset)
+            length = ENTRY_HEADER.size + id_len + record_len + 4
+            if offset + length > len(data):
+                break
+            body = data[offset:offset + length - 4]
+            if zlib.crc32(body) != struct.unpack_from("<I", data, offset + length - 4)[0]:
+                break
+            record_id = body[ENTRY_HEADER.size:ENTRY_HEADER.size + id_len].decode("utf-8")
+            record = body[ENTRY_HEADER.size + id_len:].decode("utf-8")
+            offset += length
+            yield record_id, record, offset
+
+    def _repair_tail(self):
+        # A writer that died mid-append leaves a partial entry at the end of
+        # the active segment; cut it off so later entries stay scannable.
+        path = self._segment_path(self._active_segment())
+        if not os.path.exists(path):
+            return
+        end = 0
+        for record_id, record, end in self._scan(path):
+            pass
+        if os.path.getsize(path) > end:
+            logger.error(f"Truncating a torn entry at the end of {path}.")
+            os.truncate(path, end)
+
+    def _lookup(self, key):
+        index, capacity, inode = self._table
+        slot = key_hash(key) % capacity
+        for probe in range(capacity):
+            start = HEADER.size + slot * SLOT.size
+            try:
+                found = unpack_slot(index[start:start + SLOT.size])
+            except ValueError:
+                return None
+            if found is None:
+                return None
+            if found[0] == key:
+                return found[1:]
+            slot = (slot + 1) % capacity
+        return None
+
+    def _read_entry(self, segment, offset, length):
+        view = self._segments.get(segment)
+        if view is None or len(view) < offset + length:
+            with self._map_lock:
+                view = self._segments.get(segment)
+                if view is None or len(view) < offset + length:
+                    with open(self._segment_path(segment), "rb") as f:
+                        view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._segments[segment] = view
+        data = view[offset:offset + length]
+        id_len, record_len = ENTRY_HEADER.unpack_from(data)
+        if zlib.crc32(data[:-4]) != struct.unpack_from("<I", data, length - 4)[0]:
+            raise StoreError(f"Record at segment {segment} offset {offset} is corrupt.")
+        record_id = data[ENTRY_HEADER.size:ENTRY_HEADER.size + id_len].decode("utf-8")
+        return record_id, data[ENTRY_HEADER.size + id_len:-4].decode("utf-8")
+
+    def _append(self, items):
+        segment = self._active_segment()
+        path = self._segment_path(segment)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        chunks = []
+        locations = []
+        for key, (position, record) in items:
+            value = record.encode("utf-8")
+            body = ENTRY_HEADER.pack(len(key), len(value)) + key + value
+            entry = body + struct.pack("<I", zlib.crc32(body))
+            chunks.append(entry)
+            locations.append((key, segment, offset, len(entry)))
+            offset += len(entry)
+        with open(path, "ab") as f:
+            f.write(b"".join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+        return locations
+
+    def _active_segment(self):
+        names = sorted(name for name in os.listdir(self.segment_dir) if name.endswith(".seg"))
+        if not names:
+            return 1
+        segment = int(names[-1].split(".")[0])
+        if os.path.getsize(self._segment_path(segment)) >= self.segment_size:
+            return segment + 1
+        return segment
+
+    def _segment_path(self, segment):
+        return os.path.join(self.segment_dir, f"{segment:06d}.seg")
+
+    def _insert(self, f, capacity, key, segment, offset, length):
+        slot = key_hash(key) % capacity
+        while True:
+            f.seek(HEADER.size + slot * SLOT.size)
+            try:
+                found = unpack_slot(f.read(SLOT.size))
+            except ValueError:
+                found = None
+            if found is None:
+                f.seek(HEADER.size + slot * SLOT.size)
+                f.write(pack_slot(key, segment, offset, length))
+                return
+            slot = (slot + 1) % capacity
+
+    def _read_header(self, f):
+        f.seek(0)
+        magic, capacity, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise StoreError(f"{self.index_path} is not a record index.")
+        return capacity, count
+
+    def _grow(self, count):
+        index, old_capacity, inode = self._table
+        capacity = old_capacity
+        while count * 10 > capacity * 7:
+            capacity *= 2
+        slots = []
+        for position in range(old_capacity):
+            start = HEADER.size + position * SLOT.size
+            try:
+                found = unpack_slot(index[start:start + SLOT.size])
+            except ValueError:
+                found = None
+            if found is not None:
+                slots.append(found)
+        temp_path = self.index_path + ".tmp"
+        self._write_table(temp_path, capacity, slots)
+        os.replace(temp_path, self.index_path)
+        fd = os.open(os.path.dirname(os.path.abspath(self.index_path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._map_index()
+        logger.info(f"Record index grown to {capacity} slots.")
+
+    def _write_table(self, path, capacity, slots):
+        with open(path, "w+b") as f:
+            f.write(HEADER.pack(MAGIC, capacity, len(slots)))
+            f.truncate(HEADER.size + capacity * SLOT.size)
+            for key, segment, offset, length in slots:
+                self._insert(f, capacity, key, segment, offset, length)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _refresh_index(self):
+        if self._table is None or os.stat(self.index_path).st_ino != self._table[2]:
+            self._map_index()
+
+    def _map_index(self):
+        with open(self.index_path, "rb") as f:
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            inode = os.fstat(f.fileno()).st_ino
+        magic, capacity, count = HEADER.unpack_from(index)
+        if magic != MAGIC:
+            raise StoreError(f"{self.index_path} is not a record index.")
+        self._table = (index, capacity, inode)
+
+
+def import_json(json_path, store, chunk_size=10000):
+    with store.lock:
+        if os.path.exists(store.index_path):
+            raise StoreError(f"{store.index_path} already exists, refusing to import over it.")
+        store.open()
+        count = 0
+        chunk = []
+        with open(json_path, "r", encoding="utf-8") as f:
+            for item in iter_object(f):
+                chunk.append(item)
+                if len(chunk) == chunk_size:
+                    store.put_many(chunk)
+                    count += len(chunk)
+                    chunk = []
+        if chunk:
+            store.put_many(chunk)
+            count += len(chunk)
+    logger.info(f"Imported {count} records from {json_path} into {store.index_path}.")
+    return count
+
+
+def open_store(path, legacy_path=None):
+    """Open the store at ``path``, importing ``legacy_path`` on first run."""
+    store = RecordStore(path)
+    with store.lock:
+        if not os.path.exists(store.index_path) and legacy_path is not None and os.path.exists(legacy_path):
+            import_json(legacy_path, store)
+        store.open()
+    return store
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    if len(sys.argv) >= 3 and sys.argv[1] == "import":
+        import_json(sys.argv[2], RecordStore(sys.argv[3] if len(sys.argv) > 3 else "equacks_records"))
+    else:
+        print("Usage: python store.py import <equacks_record_db.json> [store path]")
+        sys.exit(1)
@@ -0,0 +1,95 @@
+"""Helpers for reading and writing large datasets a piece at a time.
+
+``iter_object`` walks the top-level object of a JSON file such as the legacy
+``equacks_database.json`` one key at a time, so only the value being parsed
+has to fit in memory. ``ndjson_lines`` and ``csv_lines`` turn rows into
+output chunks that can be written to a file or returned as a streamed
+response. The same module is copied into src/ and records/; keep the copies
+in sync.
+"""
+import csv
+import io
+import json
+
+WHITESPACE = " \t\n\r"
+
+
+def iter_object(f, chunk_size=1 << 16):
+    """Yield the ``(key, value)`` pairs of the JSON object in text file ``f``."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def more():
+        nonlocal buffer, position, eof
+        data = f.read(chunk_size)
+        if not data:
+            eof = True
+        buffer = buffer[position:] + data
+        position = 0
+
+    def peek():
+        # Skips whitespace and returns the next character, or "" at the end.
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+            if position < len(buffer) or eof:
+                return buffer[position:position + 1]
+            more()
+
+    def value():
+        nonlocal position
+        while True:
+            try:
+                result, end = decoder.raw_decode(buffer, position)
+                # A number cut off by the end of the chunk still parses, as
+                # "12" out of "123" or "1" out of "1.5", so only trust values
+                # that are followed by something that can end them.
+                if eof or (end < len(buffer) and buffer[end] in WHITESPACE + ",:}"):
+                    position = end
+                    return result
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            more()
+
+    if peek() != "{":
+        raise ValueError("Expected a JSON object.")
+    position += 1
+    if peek() == "}":
+        return
+    while True:
+        peek()
+        key = value()
+        if not isinstance(key, str) or peek() != ":":
+            raise ValueError(f"Malformed JSON object near character {position}.")
+        position += 1
+        peek()
+        yield key, value()
+        separator = peek()
+        position += 1
+        if separator == "}":
+            return
+        if separator != ",":
+            raise ValueError(f"Malformed JSON object near character {position}.")
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+def csv_lines(rows, fields, rows_per_chunk=1000):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    writer.writeheader()
+    for index, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if index % rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,113 @@
+"""Bounded, prioritised admission for expensive work such as argon2 hashing.
+
+Each process runs a fixed number of worker threads fed from a priority queue
+that holds at most ``max_pending`` jobs, counting the ones being worked on.
+A job that arrives when the queue is full is refused straight away with
+``Overloaded`` instead of waiting behind everyone else, so a burst turns
+into quick 503s rather than a pile of requests that all time out.
+
+The last ``reserved`` places are only given to ``HIGH`` priority jobs, and
+queued ``HIGH`` jobs are picked before ``NORMAL`` ones, so service accounts
+keep moving while anonymous sign-ups are being shed.
+
+Threads do not survive a fork, so the workers are started by the first job in
+each process rather than at import. That way a gunicorn worker forked from a
+``--preload``-ed app gets workers of its own instead of queueing forever.
+"""
+from concurrent.futures import Future, TimeoutError
+import itertools
+import math
+import os
+import queue
+import threading
+import time
+import metrics
+
+HIGH = 0
+NORMAL = 1
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Too busy, retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, workers, max_pending, reserved=0, name="admission", timeout=30):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.reserved = min(reserved, max_pending - 1)
+        self.name = name
+        self.timeout = timeout
+        self.average = 0.05
+        self._order = itertools.count()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def run(self, function, *args, priority=NORMAL):
+        """Run ``function(*args)`` on a worker and return its result.
+
+        Raises ``Overloaded`` if the queue is full, or if the job has not
+        finished after ``timeout`` seconds.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        limit = self.max_pending if priority == HIGH else self.max_pending - self.reserved
+        with self._lock:
+            if self.pending >= limit:
+                metrics.increment("shed")
+                raise Overloaded(self.retry_after())
+            self.pending += 1
+        future = Future()
+        queued = time.perf_counter()
+        self._queue.put((priority, next(self._order), future, function, args))
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # A job that never started is dropped by the worker that picks it
+            # up; one that is already running just has its result thrown away.
+            future.cancel()
+            metrics.increment("admission_timeout")
+            raise Overloaded(self.retry_after())
+        finally:
+            metrics.observe("admission_wait", getattr(future, "started", time.perf_counter()) - queued)
+
+    def retry_after(self):
+        # Roughly how long the jobs already admitted will take to clear.
+        return max(1, math.ceil(self.pending * self.average / self.workers))
+
+    def _reset(self):
+        # Also runs in a freshly forked child, where the parent's lock may
+        # have been held by a thread that no longer exists.
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._queue = queue.PriorityQueue()
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            for index in range(self.workers):
+                threading.Thread(target=self._work, name=f"{self.name}-{index}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            priority, order, future, function, args = self._queue.get()
+            start = future.started = time.perf_counter()
+            if not future.set_running_or_notify_cancel():
+                with self._lock:
+                    self.pending -= 1
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                duration = time.perf_counter() - start
+                with self._lock:
+                    self.pending -= 1
+                    self.average = 0.9 * self.average + 0.1 * duration
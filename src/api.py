@@ -1,7 +1,8 @@
-from flask import Flask, request
+from flask import Flask, Response, request
 from filelock import FileLock
 import json
 import hashlib
+import hmac
 import os
 import time
 import logging
@@ -10,242 +11,585 @@ from flask_limiter.util import get_remote_address
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
 from markupsafe import escape
-import requests
+from storage import open_storage
+from locks import AccountLocks
+from admission import HIGH, NORMAL, AdmissionController, Overloaded
+from outbox import Outbox
+from http_client import HTTPClient
+from history import OPENING, SENT, AccountHistory
+from export import account_fields, account_rows, audit, format_rows
+from streaming import ndjson_lines
+from sessions import SessionSigner, load_secret
+import metrics
+import ratelimit  # registers the sqlite:// rate limit storage
 
 ph = PasswordHasher()
 app = Flask(__name__)
 database_path = "equacks_database.json"
+storage_path = "equacks_database"
+storage_backend = os.environ.get("equacks_storage", "ledger")
 lock_path = "equacks_database.lock"
+outbox_path = "equacks_receipts.outbox"
+history_path = "equacks_history"
+session_key_path = "equacks_session.key"
+metrics_path = "equacks_metrics"
+ratelimit_uri = os.environ.get("ratelimit_storage_uri", "sqlite:///equacks_ratelimit.sqlite3")
+records_url = os.environ.get("records_url", "https://equacksrecord.pythonanywhere.com")
+admin_password = os.environ.get("admin_password")
+trusted_accounts = {name.strip() for name in os.environ.get("trusted_service_accounts", "").split(",") if name.strip()}
+trusted_addresses = {address.strip() for address in os.environ.get("trusted_service_addresses", "").split(",") if address.strip()}
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+metrics.instrument(app, "bank", metrics_path)
 lock = FileLock(lock_path)
+storage = open_storage(storage_backend, storage_path, database_path, lock)
+account_locks = AccountLocks(storage_path + ".locks")
+
+records_client = HTTPClient(
+    records_url,
+    connect_timeout=float(os.environ.get("upstream_connect_timeout", "3.05")),
+    read_timeout=float(os.environ.get("upstream_read_timeout", "10")),
+    name="records"
+)
+outbox = Outbox(outbox_path, records_client, os.environ.get("record_db_password"))
+outbox.start_worker()
+history = AccountHistory(history_path)
+
+session_signer = SessionSigner(load_secret(session_key_path), lifetime=int(os.environ.get("session_lifetime", "3600")))
 
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
-    default_limits=["10 per minute"]
+    default_limits=["10 per minute"],
+    storage_uri=ratelimit_uri,
+    strategy="sliding-window-counter"
 )
 
+# Argon2 releases the GIL, so hashing on workers sized to the machine lets
+# password checks run in parallel instead of one at a time behind the lock.
+# Past max_pending queued hashes, new requests are turned away with a 503;
+# the last quarter of the queue is kept for trusted service accounts calling
+# from a trusted address. With no trusted addresses configured nobody could
+# use that quarter, so nothing is held back.
+hash_workers = os.cpu_count() or 1
+max_pending_hashes = int(os.environ.get("max_pending_hashes", str(hash_workers * 8)))
+reserved_hashes = max_pending_hashes // 4 if trusted_addresses else 0
+if trusted_accounts and not trusted_addresses:
+    logging.warning("trusted_service_accounts is set but trusted_service_addresses is not, so service accounts get no reserved hash slots.")
+hashing = AdmissionController(hash_workers, max_pending_hashes, reserved=reserved_hashes, name="argon2")
+
+def warm_up():
+    """Get this worker ready for traffic.
+
+    Runs at the end of the import unless ``warm_up=0`` is set. The ledger has
+    its index in memory once opened, so this matters most for SQLite. There
+    is no argon2 set-up to do ahead of time: the first hash costs the same as
+    any other.
+    """
+    with metrics.timed("warm_up"):
+        storage.warm_up()
+
+def priority_for(username):
+    # The username is only a claim until the hash has been checked, so it
+    # cannot earn the reserved places by itself: anyone could send the
+    # faucet's name with a wrong password and crowd the faucet out.
+    if username in trusted_accounts and get_remote_address() in trusted_addresses:
+        return HIGH
+    return NORMAL
+
+def hash_password(password, priority=NORMAL):
+    with metrics.timed("hash"):
+        return hashing.run(ph.hash, password, priority=priority)
+
+def verify_password(hashed_password, password, priority=NORMAL):
+    with metrics.timed("hash_verify"):
+        try:
+            return hashing.run(ph.verify, hashed_password, password, priority=priority)
+        except VerifyMismatchError:
+            return False
+
+def overloaded_response(e, html=True):
+    headers = {"Retry-After": str(e.retry_after)}
+    if html:
+        return """<p>The bank is busy right now, please try again in a moment.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 503, headers
+    return {"error": "The bank is busy right now, please try again in a moment."}, 503, headers
+
+def authenticate(username, account, password, token):
+    # A valid session token skips argon2 entirely; otherwise fall back to
+    # the password if one was sent.
+    if isinstance(token, str) and session_signer.check(token, username, account["password"]):
+        return True
+    if isinstance(password, str):
+        return verify_password(account["password"], password, priority_for(username))
+    return False
+
+def is_admin(password):
+    return isinstance(admin_password, str) and isinstance(password, str) and hmac.compare_digest(password.encode("utf-8"), admin_password.encode("utf-8"))
+
+def batch_sender_key():
+    # The username is unchecked until the hash has run, so on its own it
+    # would let anyone use up a service account's allowance. Keying on the
+    # address as well keeps each caller to its own budget.
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and isinstance(data.get('username'), str):
+        return "batch:" + data['username'] + "@" + get_remote_address()
+    return "batch-ip:" + get_remote_address()
+
 @app.route('/create_account', methods=['POST'])
 def create_account():
     try:
-        with lock:
-            if request.is_json:
-                data = request.json
-            else:
-                data = request.form
-            username = data.get('username')
-            password = data.get('password')
-
-            if not isinstance(username, str):
-                return "Username must be string.", 400
-            if not isinstance(password, str):
-                return "Password must be string.", 400
-
-            if len(username) > 50:
-                return """<p>Username cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-            if len(password) > 50:
-                return """<p>Password cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            if not os.path.exists(database_path):
-                with open(database_path, "w") as f:
-                    json.dump({}, f)
-
-            with open(database_path, 'r') as f:
-                database = json.load(f)
-
-            if username in database:
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+        username = data.get('username')
+        password = data.get('password')
+
+        if not isinstance(username, str):
+            return "Username must be string.", 400
+        if not isinstance(password, str):
+            return "Password must be string.", 400
+
+        if len(username) > 50:
+            return """<p>Username cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+        if len(password) > 50:
+            return """<p>Password cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        if storage.get(username) is not None:
+            return """<p>Username taken. Pick another one.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        hashed_password = hash_password(password, priority_for(username))
+
+        with account_locks.hold(username):
+            if storage.get(username) is not None:
                 return """<p>Username taken. Pick another one.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+            storage.commit([(username, {"password": hashed_password, "balance": 0})])
 
-            hashed_password = ph.hash(password)
-            database[username] = {"password": hashed_password, "balance": 0}
-
-            temp_path = database_path + ".tmp"
-            with open(temp_path, "w") as f:
-                json.dump(database, f)
-            os.rename(temp_path, database_path)
-
-            logging.info(f"Account successfully created: {username}")
-            return '<p>Success, user added!</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>', 200
+        logging.info(f"Account successfully created: {username}")
+        return '<p>Success, user added!</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>', 200
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         logging.error("Account unsuccessfully created: " + str(e))
         return """<p>Generic error.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 500
+@app.route('/login', methods=['POST'])
+def login():
+    try:
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+        username = data.get('username')
+        password = data.get('password')
+
+        if not isinstance(username, str):
+            return {"error": "Username must be string."}, 400
+        if not isinstance(password, str):
+            return {"error": "Password must be string."}, 400
+        if len(username) > 50 or len(password) > 50:
+            return {"error": "Username and password cannot be longer than 50 characters."}, 400
+
+        account = storage.get(username)
+        if account is None:
+            return {"error": "User does not exist."}, 400
+
+        if not verify_password(account["password"], password, priority_for(username)):
+            logging.error(f"{username} unsuccessfully logged in because of invalid password.")
+            return {"error": "Incorrect password."}, 400
+
+        token, expires = session_signer.issue(username, account["password"])
+        logging.info(f"{username} successfully logged in.")
+        return {"token": token, "expires": expires}, 200
+    except Overloaded as e:
+        return overloaded_response(e, html=False)
+    except Exception as e:
+        logging.error("Login unsuccessful: " + str(e))
+        return {"error": "Generic error."}, 500
 @app.route('/delete_account', methods=['POST'])
 def delete_account():
     try:
-        with lock:
-            if request.is_json:
-                data = request.json
-            else:
-                data = request.form
-            username = data.get('username')
-            password = data.get('password')
-
-            if not isinstance(username, str):
-                return "Username must be string.", 400
-            if not isinstance(password, str):
-                return "Password must be string.", 400
-
-            if len(username) > 50:
-                return """<p>Username cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-            if len(password) > 50:
-                return """<p>Password cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            if not os.path.exists(database_path):
-                with open(database_path, "w") as f:
-                    json.dump({}, f)
-
-            with open(database_path, 'r') as f:
-                database = json.load(f)
-
-            if not username in database:
-                return """<p>User does not exist.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            try:
-                ph.verify(database[username]["password"], password)
-            except VerifyMismatchError:
-                logging.error(f"{username} unsuccessfully logged in because of invalid password.")
-                return """<p>Incorrect password.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            balance = database[username]['balance']
-            del database[username]
-
-            temp_path = database_path + ".tmp"
-            with open(temp_path, "w") as f:
-                json.dump(database, f)
-            os.rename(temp_path, database_path)
-
-            logging.info(f"Account successfully deleted: {username} with a balance of {balance}.")
-            return '<p>Success, user deleted!</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>', 200
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+        username = data.get('username')
+        password = data.get('password')
+        token = data.get('token')
+
+        if not isinstance(username, str):
+            return "Username must be string.", 400
+        if not isinstance(password, str) and not isinstance(token, str):
+            return "Password must be string.", 400
+
+        if len(username) > 50:
+            return """<p>Username cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+        if isinstance(password, str) and len(password) > 50:
+            return """<p>Password cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        account = storage.get(username)
+        if account is None:
+            return """<p>User does not exist.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        if not authenticate(username, account, password, token):
+            logging.error(f"{username} unsuccessfully logged in because of invalid password.")
+            return """<p>Incorrect password.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        with account_locks.hold(username):
+            current = storage.get(username)
+            if current is None or current["password"] != account["password"]:
+                return """<p>Account changed while processing, please try again.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 409
+            balance = current['balance']
+            storage.commit([(username, None)])
+            history.remove(username)
+
+        logging.info(f"Account successfully deleted: {username} with a balance of {balance}.")
+        return '<p>Success, user deleted!</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>', 200
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         logging.error("Account unsuccessfully deleted: " + str(e))
         return """<p>Generic error.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 500
 @app.route('/transfer_currency', methods=['POST'])
 def transfer_currency():
     try:
-        with lock:
-            if request.is_json:
-                data = request.json
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+        username = data.get('username')
+        password = data.get('password')
+        token = data.get('token')
+        receiver = data.get('receiver')
+        amount = data.get('amount')
+
+        if not isinstance(username, str):
+            return "Username must be string.", 400
+        if not isinstance(password, str) and not isinstance(token, str):
+            return "Password must be string.", 400
+        if not isinstance(receiver, str):
+            return "Receiver must be string.", 400
+        if not isinstance(amount, str):
+            return "Amount must be string.", 400
+
+        if amount.isdigit():
+            if int(amount) > 0:
+                amount = int(amount)
             else:
-                data = request.form
-            username = data.get('username')
-            password = data.get('password')
-            receiver = data.get('receiver')
-            amount = data.get('amount')
-
-            if not isinstance(username, str):
-                return "Username must be string.", 400
-            if not isinstance(password, str):
-                return "Password must be string.", 400
-            if not isinstance(receiver, str):
-                return "Receiver must be string.", 400
-            if not isinstance(amount, str):
-                return "Amount must be string.", 400
-
-            if amount.isdigit():
-                if int(amount) > 0:
-                    amount = int(amount)
-                else:
-                    return """<p>Amount must be larger than zero.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-            else:
-                return """<p>Amount must be a digit.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            if len(username) > 50:
-                return """<p>Username cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-            if len(password) > 50:
-                return """<p>Password cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-            if len(receiver) > 50:
-                return """<p>Receiver cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            if not os.path.exists(database_path):
-                with open(database_path, "w") as f:
-                    json.dump({}, f)
-
-            with open(database_path, 'r') as f:
-                database = json.load(f)
-
-            if not username in database:
-                return """<p>User does not exist.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-            if not receiver in database:
+                return """<p>Amount must be larger than zero.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+        else:
+            return """<p>Amount must be a digit.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        if len(username) > 50:
+            return """<p>Username cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+        if isinstance(password, str) and len(password) > 50:
+            return """<p>Password cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+        if len(receiver) > 50:
+            return """<p>Receiver cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        account = storage.get(username)
+        if account is None:
+            return """<p>User does not exist.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+        if storage.get(receiver) is None:
+            return """<p>Receiver does not exist.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        if not authenticate(username, account, password, token):
+            logging.error(f"{username} unsuccessfully logged in because of invalid password.")
+            return """<p>Incorrect password.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        if username == receiver:
+            return """<p>You cannot transfer currency to yourself.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        with account_locks.hold(username, receiver):
+            # The balances may have moved while the password was being checked.
+            current = storage.get(username)
+            receiver_account = storage.get(receiver)
+            if current is None or current["password"] != account["password"]:
+                return """<p>Account changed while processing, please try again.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 409
+            if receiver_account is None:
                 return """<p>Receiver does not exist.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
 
-            try:
-                ph.verify(database[username]["password"], password)
-            except VerifyMismatchError:
-                logging.error(f"{username} unsuccessfully logged in because of invalid password.")
-                return """<p>Incorrect password.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            if not database[username]['balance'] >= amount:
+            if not current['balance'] >= amount:
                 return """<p>You don't have enough currency to make this transaction.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
 
-            if username == receiver:
-                return """<p>You cannot transfer currency to yourself.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            database[username]['balance'] = database[username]['balance'] - amount
-            database[receiver]['balance'] = database[receiver]['balance'] + amount
-
-            temp_path = database_path + ".tmp"
-            with open(temp_path, "w") as f:
-                json.dump(database, f)
-            os.rename(temp_path, database_path)
-
-            record_data = {
-                "password": os.environ.get("record_db_password"),
-                "record": f"""{username} sent {receiver} {amount} eQuacks on {int(time.time())} Unix time."""
-            }
-            record_response = requests.post("https://equacksrecord.pythonanywhere.com/submit_record", json=record_data)
-            if record_response.status_code == 200:
-                logging.info(f"Transaction successfully sent from {username} to {receiver} with an amount of {amount}.")
-                return f"""<p>Success, transaction sent!</p><p>Permanent transaction receipt:</p><a href="{escape('https://equacksrecord.pythonanywhere.com/get_record/' + record_response.text)}">{escape('https://equacksrecord.pythonanywhere.com/get_record/' + record_response.text)}</a><br><br><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 200
-            else:
-                logging.info(f"Transaction successfully sent from {username} to {receiver} with an amount of {amount}. But, receipt could not be made because {escape(record_response.text)}.")
-                return """<p>Success, transaction sent! But, the receipt could not be made.<p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 200
+            storage.commit([
+                (username, {"password": current["password"], "balance": current["balance"] - amount}),
+                (receiver, {"password": receiver_account["password"], "balance": receiver_account["balance"] + amount})
+            ])
+            now = int(time.time())
+            receipt_id = outbox.new_id()
+            history.record([(username, receiver, amount, now, receipt_id)], {username: current["balance"], receiver: receiver_account["balance"]})
+
+        outbox.submit(f"""{username} sent {receiver} {amount} eQuacks on {now} Unix time.""", receipt_id)
+        receipt_url = records_url + "/get_record/" + receipt_id
+        logging.info(f"Transaction successfully sent from {username} to {receiver} with an amount of {amount}.")
+        return f"""<p>Success, transaction sent!</p><p>Permanent transaction receipt:</p><a href="{escape(receipt_url)}">{escape(receipt_url)}</a><br><br><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 200
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         logging.error("Transaction unsuccessfully sent: " + str(e))
         return """<p>Generic error.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 500
+@app.route('/transfer_batch', methods=['POST'])
+@limiter.limit("60 per minute", key_func=batch_sender_key)
+@limiter.limit("120 per minute")
+def transfer_batch():
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return {"error": "Body must be a JSON object."}, 400
+        username = data.get('username')
+        password = data.get('password')
+        token = data.get('token')
+        transfers = data.get('transfers')
+
+        if not isinstance(username, str):
+            return {"error": "Username must be string."}, 400
+        if not isinstance(password, str) and not isinstance(token, str):
+            return {"error": "Password must be string."}, 400
+        if not isinstance(transfers, list) or not transfers:
+            return {"error": "Transfers must be a non-empty list."}, 400
+        if len(transfers) > 500:
+            return {"error": "A batch cannot have more than 500 transfers."}, 400
+        if len(username) > 50 or (isinstance(password, str) and len(password) > 50):
+            return {"error": "Username and password cannot be longer than 50 characters."}, 400
+
+        if username not in trusted_accounts:
+            return {"error": "Batch transfers are only available to service accounts."}, 403
+
+        # Validate every line before doing anything, so the batch either
+        # applies completely or not at all.
+        results = []
+        for line in transfers:
+            receiver = line.get('receiver') if isinstance(line, dict) else None
+            amount = line.get('amount') if isinstance(line, dict) else None
+            result = {"receiver": receiver, "amount": amount}
+            if not isinstance(receiver, str):
+                result["error"] = "Receiver must be string."
+            elif len(receiver) > 50:
+                result["error"] = "Receiver cannot be longer than 50 characters."
+            elif receiver == username:
+                result["error"] = "You cannot transfer currency to yourself."
+            elif not isinstance(amount, str):
+                result["error"] = "Amount must be string."
+            elif not (amount.isascii() and amount.isdigit()):
+                result["error"] = "Amount must be a digit."
+            elif not int(amount) > 0:
+                result["error"] = "Amount must be larger than zero."
+            elif storage.get(receiver) is None:
+                result["error"] = "Receiver does not exist."
+            results.append(result)
+        if any("error" in result for result in results):
+            return {"error": "No transfers were made because some lines are invalid.", "results": results}, 400
+
+        account = storage.get(username)
+        if account is None:
+            return {"error": "User does not exist."}, 400
+
+        if not authenticate(username, account, password, token):
+            logging.error(f"{username} unsuccessfully logged in because of invalid password.")
+            return {"error": "Incorrect password."}, 400
+
+        lines = [(line['receiver'], int(line['amount'])) for line in transfers]
+        total = sum(amount for receiver, amount in lines)
+        receivers = {receiver for receiver, amount in lines}
+
+        with account_locks.hold(username, *receivers):
+            current = storage.get(username)
+            if current is None or current["password"] != account["password"]:
+                return {"error": "Account changed while processing, please try again."}, 409
+            if not current['balance'] >= total:
+                return {"error": "You don't have enough currency to make these transactions."}, 400
+
+            balances = {}
+            for receiver in receivers:
+                receiver_account = storage.get(receiver)
+                if receiver_account is None:
+                    for result in results:
+                        if result["receiver"] == receiver:
+                            result["error"] = "Receiver does not exist."
+                    return {"error": "No transfers were made because some lines are invalid.", "results": results}, 400
+                balances[receiver] = receiver_account
+
+            credited = {receiver: 0 for receiver in receivers}
+            for receiver, amount in lines:
+                credited[receiver] += amount
+            changes = [(username, {"password": current["password"], "balance": current["balance"] - total})]
+            for receiver in receivers:
+                changes.append((receiver, {"password": balances[receiver]["password"], "balance": balances[receiver]["balance"] + credited[receiver]}))
+            storage.commit(changes)
+            now = int(time.time())
+            receipt_ids = [outbox.new_id() for line in lines]
+            opening = {receiver: balances[receiver]["balance"] for receiver in receivers}
+            opening[username] = current["balance"]
+            history.record([(username, receiver, amount, now, receipt_id) for (receiver, amount), receipt_id in zip(lines, receipt_ids)], opening)
+
+        outbox.submit_many([f"""{username} sent {receiver} {amount} eQuacks on {now} Unix time.""" for receiver, amount in lines], receipt_ids)
+        for result, receipt_id in zip(results, receipt_ids):
+            result["receipt"] = records_url + "/get_record/" + receipt_id
+
+        logging.info(f"Batch of {len(lines)} transactions successfully sent from {username} with a total of {total}.")
+        return {"results": results}, 200
+    except Overloaded as e:
+        return overloaded_response(e, html=False)
+    except Exception as e:
+        logging.error("Transaction batch unsuccessfully sent: " + str(e))
+        return {"error": "Generic error."}, 500
 @app.route('/get_balance', methods=['POST'])
 def get_balance():
     try:
-        with lock:
-            if request.is_json:
-                data = request.json
-            else:
-                data = request.form
-            username = data.get('username')
-            password = data.get('password')
-
-            if not isinstance(username, str):
-                return "Username must be string.", 400
-            if not isinstance(password, str):
-                return "Password must be string.", 400
-
-            if len(username) > 50:
-                return """<p>Username cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-            if len(password) > 50:
-                return """<p>Password cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
-
-            if not os.path.exists(database_path):
-                with open(database_path, "w") as f:
-                    json.dump({}, f)
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+        username = data.get('username')
+        password = data.get('password')
+        token = data.get('token')
+
+        if not isinstance(username, str):
+            return "Username must be string.", 400
+        if not isinstance(password, str) and not isinstance(token, str):
+            return "Password must be string.", 400
+
+        if len(username) > 50:
+            return """<p>Username cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+        if isinstance(password, str) and len(password) > 50:
+            return """<p>Password cannot be longer than 50 characters.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        account = storage.get(username)
+        if account is None:
+            return """<p>User does not exist.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        if not authenticate(username, account, password, token):
+            logging.error(f"{username} unsuccessfully logged in because of invalid password.")
+            return """<p>Incorrect password.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+
+        current = storage.get(username)
+        if current is None or current["password"] != account["password"]:
+            return """<p>Account changed while processing, please try again.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 409
+        balance = str(current['balance'])
+
+        logging.info(f"{username} successfully counted a balance of {balance}.")
+        return f"""<p>You have {balance} eQuack/s.</p> <a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 200
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logging.error(f"{username} unsuccessfully counted their balance. " + str(e))
+        return """<p>Generic error.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 500
+@app.route('/history', methods=['POST'])
+def transaction_history():
+    try:
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+        username = data.get('username')
+        password = data.get('password')
+        token = data.get('token')
+        cursor = data.get('cursor')
+        limit = data.get('limit', "100")
+
+        if not isinstance(username, str):
+            return {"error": "Username must be string."}, 400
+        if not isinstance(password, str) and not isinstance(token, str):
+            return {"error": "Password must be string."}, 400
+        if cursor is not None and (not isinstance(cursor, str) or not (cursor.isascii() and cursor.isdigit())):
+            return {"error": "Cursor must be a digit."}, 400
+        if not isinstance(limit, str) or not (limit.isascii() and limit.isdigit()) or not 0 < int(limit) <= 1000:
+            return {"error": "Limit must be a digit between 1 and 1000."}, 400
+        if len(username) > 50 or (isinstance(password, str) and len(password) > 50):
+            return {"error": "Username and password cannot be longer than 50 characters."}, 400
+
+        account = storage.get(username)
+        if account is None:
+            return {"error": "User does not exist."}, 400
+
+        if not authenticate(username, account, password, token):
+            logging.error(f"{username} unsuccessfully logged in because of invalid password.")
+            return {"error": "Incorrect password."}, 400
+
+        end = history.count(username)
+        if cursor is not None:
+            end = min(end, int(cursor))
+        start = max(0, end - int(limit))
+
+        def generate():
+            try:
+                for direction, timestamp, amount, counterparty, receipt_id in history.entries(username, end, end - start):
+                    if direction == OPENING:
+                        continue
+                    sender, receiver = (username, counterparty) if direction == SENT else (counterparty, username)
+                    yield json.dumps({
+                        "sender": sender,
+                        "receiver": receiver,
+                        "amount": amount,
+                        "time": timestamp,
+                        "receipt": records_url + "/get_record/" + receipt_id
+                    }) + "\n"
+            except Exception as e:
+                logging.error(f"History of {username} could not be streamed: " + str(e))
+
+        headers = {"Cache-Control": "no-store"}
+        if start > 0:
+            headers["X-Next-Cursor"] = str(start)
+        return Response(generate(), mimetype="application/x-ndjson", headers=headers)
+    except Overloaded as e:
+        return overloaded_response(e, html=False)
+    except Exception as e:
+        logging.error("History unsuccessfully listed: " + str(e))
+        return {"error": "Generic error."}, 500
+@app.route('/admin/export', methods=['POST'])
+def admin_export():
+    try:
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
+        output_format = data.get('format', "ndjson")
+
+        if not is_admin(data.get('password')):
+            return {"error": "Invalid password. Please note that only admins should use this."}, 403
+        if output_format not in ("ndjson", "csv"):
+            return {"error": "Format must be ndjson or csv."}, 400
+
+        def generate():
+            try:
+                yield from format_rows(account_rows(storage.iter_accounts()), output_format, account_fields)
+            except Exception as e:
+                logging.error("Account export was cut short: " + str(e))
 
-            with open(database_path, 'r') as f:
-                database = json.load(f)
+        logging.info("Accounts exported by an admin.")
+        return Response(generate(), mimetype="text/csv" if output_format == "csv" else "application/x-ndjson", headers={"Cache-Control": "no-store"})
+    except Exception as e:
+        logging.error("Accounts unsuccessfully exported: " + str(e))
+        return {"error": "Generic error."}, 500
+@app.route('/admin/audit', methods=['POST'])
+def admin_audit():
+    try:
+        if request.is_json:
+            data = request.json
+        else:
+            data = request.form
 
-            if not username in database:
-                return """<p>User does not exist.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+        if not is_admin(data.get('password')):
+            return {"error": "Invalid password. Please note that only admins should use this."}, 403
 
+        def generate():
             try:
-                ph.verify(database[username]["password"], password)
-            except VerifyMismatchError:
-                logging.error(f"{username} unsuccessfully logged in because of invalid password.")
-                return """<p>Incorrect password.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 400
+                yield from ndjson_lines(audit(storage, history))
+            except Exception as e:
+                logging.error("Audit was cut short: " + str(e))
 
-            balance = str(database[username]['balance'])
-
-            logging.info(f"{username} successfully counted a balance of {balance}.")
-            return f"""<p>You have {balance} eQuack/s.</p> <a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 200
+        logging.info("Audit started by an admin.")
+        return Response(generate(), mimetype="application/x-ndjson", headers={"Cache-Control": "no-store"})
     except Exception as e:
-        logging.error(f"{username} unsuccessfully counted their balance. " + str(e))
-        return """<p>Generic error.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 500
+        logging.error("Audit unsuccessfully started: " + str(e))
+        return {"error": "Generic error."}, 500
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def metrics_page():
+    try:
+        return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+    except Exception as e:
+        logging.error("Unsuccessfully rendered the metrics. " + str(e))
+        return "Generic error.", 500
 @app.route('/ping', methods=['GET'])
 def ping():
     try:
@@ -255,20 +599,27 @@ def ping():
 @app.route('/total_supply', methods=['GET'])
 def total_supply():
     try:
-        if not os.path.exists(database_path):
-            with open(database_path, "w") as f:
-                json.dump({}, f)
-
-        with open(database_path, 'r') as f:
-            database = json.load(f)
-
-        supply = 0
-
-        for user in database:
-            supply += database[user]['balance']
-
-        return f"""<p>There is a total supply of {supply} eQuack/s.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 200
+        supply = storage.stats()["supply"]
+        return f"""<p>There is a total supply of {supply} eQuack/s.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 200, {"Cache-Control": "public, max-age=10"}
 
     except Exception as e:
         logging.error(f"Unsuccessfully counted the total supply." + str(e))
         return """<p>Generic error.</p><a href="https://equacks.seafoodstudios.com/">Go back to homepage</a>""", 500
+@app.route('/supply_stats', methods=['GET'])
+def supply_stats():
+    try:
+        stats = storage.stats()
+        distribution = []
+        for bucket, count in sorted(stats["histogram"].items()):
+            distribution.append({
+                "min_balance": 0 if bucket == 0 else 2 ** (bucket - 1),
+                "max_balance": 0 if bucket == 0 else 2 ** bucket - 1,
+                "accounts": count
+            })
+        return {"supply": stats["supply"], "accounts": stats["accounts"], "distribution": distribution}, 200, {"Cache-Control": "public, max-age=10"}
+    except Exception as e:
+        logging.error(f"Unsuccessfully counted the supply stats." + str(e))
+        return "Generic error.", 500
+
+if os.environ.get("warm_up", "1") != "0":
+    warm_up()
@@ -0,0 +1,119 @@
+"""Stream the bank's accounts out, and audit them, in bounded memory.
+
+    python export.py accounts --format csv --output accounts.csv
+    python export.py accounts --legacy equacks_database.json
+    python export.py audit
+
+``accounts`` writes one row per account with its username and balance;
+password hashes are never exported. With ``--legacy`` the rows come straight
+from an old JSON database, parsed one account at a time.
+
+``audit`` replays every account's transaction history and compares the result
+with its balance, then recounts the supply and the balance histogram and
+compares them with the running totals. It prints one NDJSON line per
+discrepancy and a summary line last. Only one account's history is read at a
+time. Each history starts from the opening balance recorded with the
+account's first transfer; an account with no history has not moved since
+history began and is taken as it stands. Transfers that land while the audit
+runs can show up as transient differences, so run it against a quiet bank for
+a clean report.
+"""
+from filelock import FileLock
+import argparse
+import os
+import sys
+import logging
+from history import SENT, AccountHistory
+from ledger import balance_bucket
+from storage import make_storage
+from streaming import csv_lines, iter_object, ndjson_lines
+
+account_fields = ["username", "balance"]
+
+
+def legacy_accounts(json_path):
+    with open(json_path, "r", encoding="utf-8") as f:
+        yield from iter_object(f)
+
+
+def account_rows(accounts):
+    for username, account in accounts:
+        yield {"username": username, "balance": account["balance"]}
+
+
+def format_rows(rows, output_format, fields):
+    if output_format == "csv":
+        return csv_lines(rows, fields)
+    return ndjson_lines(rows)
+
+
+def audit(storage, history):
+    stats = storage.stats()
+    supply = 0
+    count = 0
+    histogram = {}
+    discrepancies = 0
+    for username, account in storage.iter_accounts():
+        balance = account["balance"]
+        supply += balance
+        count += 1
+        bucket = balance_bucket(balance)
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        net = 0
+        entries = 0
+        for direction, timestamp, amount, counterparty, receipt_id in history.entries(username, limit=history.count(username)):
+            net += -amount if direction == SENT else amount
+            entries += 1
+        if entries and net != balance:
+            discrepancies += 1
+            yield {"username": username, "balance": balance, "history_net": net, "history_entries": entries, "difference": balance - net}
+
+    yield {"summary": {
+        "accounts": count,
+        "running_accounts": stats["accounts"],
+        "supply": supply,
+        "running_supply": stats["supply"],
+        "histogram_matches": histogram == stats["histogram"],
+        "discrepancies": discrepancies
+    }}
+
+
+def open_existing(kind, path):
+    storage = make_storage(kind, path, FileLock(path + ".lock"))
+    if not storage.exists():
+        raise FileNotFoundError(f"There is no {kind} storage at {path}.")
+    with storage.lock:
+        storage.open()
+    return storage
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["accounts", "audit"])
+    parser.add_argument("--storage", choices=["ledger", "sqlite"], default=os.environ.get("equacks_storage", "ledger"))
+    parser.add_argument("--path", default="equacks_database", help="storage path")
+    parser.add_argument("--history", default="equacks_history", help="history directory")
+    parser.add_argument("--legacy", help="read accounts from an old JSON database instead")
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--output", help="file to write to instead of stdout")
+    args = parser.parse_args()
+
+    if args.command == "accounts":
+        accounts = legacy_accounts(args.legacy) if args.legacy else open_existing(args.storage, args.path).iter_accounts()
+        lines = format_rows(account_rows(accounts), args.format, account_fields)
+    else:
+        lines = ndjson_lines(audit(open_existing(args.storage, args.path), AccountHistory(args.history)))
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        for line in lines:
+            output.write(line)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Per-account transaction history.
+
+Every account has its own append-only file of fixed-size entries under
+``<directory>/<xx>/<sha256 of username>.log``. A transfer adds one entry to
+the sender's file and one to the receiver's, so listing an account's history
+only ever reads that account's file and never the global record store.
+
+The first entry in each file records the account's balance from just before
+its first transfer, so an account that had money before history was kept
+still adds up: replaying its file from that opening balance gives the
+balance it has now.
+
+Entries never move once written, which makes an entry's position a stable
+cursor: ``entries(username, cursor)`` walks backwards from ``cursor``, newest
+first, reading a chunk at a time so a long history is served in constant
+memory.
+
+Files are only written while the caller holds the ``AccountLocks`` stripes
+of every account involved. The entries are written right after the balances
+are committed, so a crash in between can lose the history lines of that one
+transfer while the transfer itself stands, the same as its receipt.
+"""
+import hashlib
+import os
+import struct
+import zlib
+
+SENT = 0
+RECEIVED = 1
+OPENING = 2
+
+# direction, time, amount, counterparty length, counterparty, receipt length,
+# receipt id, crc32
+ENTRY = struct.Struct("<BqqH200sB64sI")
+ENTRY_BODY = struct.Struct("<BqqH200sB64s")
+
+
+def pack_entry(direction, timestamp, amount, counterparty, receipt_id):
+    name = counterparty.encode("utf-8")
+    receipt = receipt_id.encode("utf-8")
+    body = ENTRY_BODY.pack(direction, timestamp, amount, len(name), name, len(receipt), receipt)
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def unpack_entry(data):
+    direction, timestamp, amount, name_len, name, receipt_len, receipt, crc = ENTRY.unpack(data)
+    if zlib.crc32(data[:ENTRY_BODY.size]) != crc:
+        return None
+    return direction, timestamp, amount, name[:name_len].decode("utf-8"), receipt[:receipt_len].decode("utf-8")
+
+
+class AccountHistory:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, username):
+        digest = hashlib.sha256(username.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".log")
+
+    def record(self, transfers, opening):
+        """Add ``(sender, receiver, amount, timestamp, receipt_id)`` transfers.
+
+        ``opening`` maps every account involved to its balance before these
+        transfers; it is written first to accounts with no history yet.
+        """
+        appends = {}
+        first_time = transfers[0][3] if transfers else 0
+        for sender, receiver, amount, timestamp, receipt_id in transfers:
+            appends.setdefault(sender, []).append(pack_entry(SENT, timestamp, amount, receiver, receipt_id))
+            appends.setdefault(receiver, []).append(pack_entry(RECEIVED, timestamp, amount, sender, receipt_id))
+
+        for username, entries in appends.items():
+            path = self.path(username)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if size % ENTRY.size:
+                    # A torn entry left behind by a crashed writer.
+                    os.ftruncate(fd, size - size % ENTRY.size)
+                if size < ENTRY.size:
+                    entries.insert(0, pack_entry(OPENING, first_time, opening[username], "", ""))
+                os.write(fd, b"".join(entries))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def count(self, username):
+        try:
+            return os.path.getsize(self.path(username)) // ENTRY.size
+        except FileNotFoundError:
+            return 0
+
+    def entries(self, username, cursor=None, limit=100, chunk=256):
+        """Yield up to ``limit`` entries older than ``cursor``, newest first.
+
+        Each entry is ``(direction, timestamp, amount, counterparty,
+        receipt_id)``; the oldest is the ``OPENING`` balance, with an empty
+        counterparty and receipt. Without a cursor the walk starts at the
+        newest entry.
+        """
+        try:
+            f = open(self.path(username), "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            end = os.fstat(f.fileno()).st_size // ENTRY.size
+            if cursor is not None:
+                end = min(end, cursor)
+            start = max(0, end - limit)
+            while end > start:
+                first = max(start, end - chunk)
+                f.seek(first * ENTRY.size)
+                data = f.read((end - first) * ENTRY.size)
+                for index in range(end - first - 1, -1, -1):
+                    entry = unpack_entry(data[index * ENTRY.size:(index + 1) * ENTRY.size])
+                    if entry is not None:
+                        yield entry
+                end = first
+
+    def remove(self, username):
+        try:
+            os.remove(self.path(username))
+        except FileNotFoundError:
+            pass
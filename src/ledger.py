@@ -0,0 +1,448 @@
+"""Append-only account ledger with an in-memory index.
+
+The ledger lives in two files:
+
+- ``<path>.snap``: a JSON snapshot of every account, in the same shape as the
+  old ``equacks_database.json``, tagged with a generation number.
+- ``<path>.wal``: a write-ahead log of fixed-size records written after that
+  snapshot. The first record is a header carrying the generation.
+
+Every process keeps the whole account table in memory and catches up by
+reading whatever was appended to the log since it last looked, so reads never
+parse the full database. Writes append a batch of records, fsync, and are only
+applied once the batch's commit record is on disk. A background thread folds
+the log back into a fresh snapshot once it grows past a threshold.
+
+The total supply and a histogram of balances are kept up to date as batches
+are applied and saved with each snapshot, so neither needs a full scan.
+``python ledger.py verify`` recounts both from scratch and reports any drift.
+
+Run ``python ledger.py import equacks_database.json`` once to move an existing
+JSON database over.
+"""
+from filelock import FileLock, Timeout
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+import logging
+import metrics
+from storage import Storage
+
+OP_HEADER = 0
+OP_PUT = 1
+OP_DELETE = 2
+
+FLAG_COMMIT = 1
+
+# op, flags, username length, username, balance, hash length, hash, crc32
+RECORD = struct.Struct("<BBH200sqH126sI")
+RECORD_BODY = struct.Struct("<BBH200sqH126s")
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerError(Exception):
+    pass
+
+
+def balance_bucket(balance):
+    # Bucket n holds balances in [2**(n - 1), 2**n); bucket 0 holds zero.
+    return balance.bit_length()
+
+
+def count_stats(accounts):
+    supply = 0
+    histogram = {}
+    for account in accounts.values():
+        supply += account["balance"]
+        bucket = balance_bucket(account["balance"])
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    return supply, histogram
+
+
+def snapshot_data(generation, previous_offset, accounts, supply, histogram):
+    return {
+        "generation": generation,
+        "previous_offset": previous_offset,
+        "supply": supply,
+        "histogram": histogram,
+        "accounts": accounts
+    }
+
+
+def pack_record(op, flags=0, username="", balance=0, password=""):
+    name = username.encode("utf-8")
+    hashed = password.encode("utf-8")
+    if len(name) > 200:
+        raise LedgerError("Username is too long to be stored.")
+    if len(hashed) > 126:
+        raise LedgerError("Password hash is too long to be stored.")
+    body = RECORD_BODY.pack(op, flags, len(name), name, balance, len(hashed), hashed)
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def unpack_record(data):
+    op, flags, name_len, name, balance, hash_len, hashed, crc = RECORD.unpack(data)
+    if zlib.crc32(data[:RECORD_BODY.size]) != crc:
+        return None
+    return op, flags, name[:name_len].decode("utf-8"), balance, hashed[:hash_len].decode("utf-8")
+
+
+def fsync_directory(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Ledger(Storage):
+    def __init__(self, path, lock=None):
+        self.snapshot_path = path + ".snap"
+        self.wal_path = path + ".wal"
+        self.lock = lock if lock is not None else FileLock(path + ".lock")
+        self.compact_lock = FileLock(path + ".compact.lock", timeout=0)
+        self.accounts = {}
+        self.generation = 0
+        self.supply = 0
+        self.histogram = {}
+        self._mutex = threading.RLock()
+        self._wal = None
+        self._offset = 0
+        self._previous_offset = 0
+        self._stale_wal = False
+
+    def open(self):
+        """Load the ledger, creating an empty log if there is none yet.
+
+        The caller must hold ``self.lock``.
+        """
+        with self._mutex:
+            self.refresh()
+            if self._wal is None or self._stale_wal:
+                self._roll_wal(self._committed_tail())
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.wal_path)
+
+    def get(self, username):
+        self.refresh()
+        return self.accounts.get(username)
+
+    def refresh(self):
+        with metrics.timed("db_load"), self._mutex:
+            try:
+                stat = os.stat(self.wal_path)
+            except FileNotFoundError:
+                stat = None
+
+            if self._wal is None or stat is None or stat.st_ino != os.fstat(self._wal.fileno()).st_ino:
+                self._reload()
+            elif stat.st_size >= self._offset + RECORD.size:
+                self._replay()
+
+    def commit(self, changes):
+        """Durably apply ``changes``, a list of ``(username, account)`` pairs.
+
+        ``account`` is a ``{"password": ..., "balance": ...}`` dict, or None to
+        delete the user. ``self.lock`` is only held for the append itself, so
+        callers must make sure nobody else changes the same accounts between
+        reading them and committing.
+        """
+        if not changes:
+            return
+        records = []
+        for index, (username, account) in enumerate(changes):
+            flags = FLAG_COMMIT if index == len(changes) - 1 else 0
+            if account is None:
+                records.append(pack_record(OP_DELETE, flags, username))
+            else:
+                records.append(pack_record(OP_PUT, flags, username, account["balance"], account["password"]))
+
+        start = time.perf_counter()
+        with self.lock:
+            metrics.observe("append_lock_wait", time.perf_counter() - start)
+            with metrics.timed("db_write"):
+                with self._mutex:
+                    self.refresh()
+                    if self._wal is None or self._stale_wal:
+                        self._roll_wal(self._committed_tail())
+                    elif os.path.getsize(self.wal_path) > self._offset:
+                        # Torn or uncommitted bytes left behind by a crashed writer.
+                        os.truncate(self.wal_path, self._offset)
+
+                # Only writers hold self.lock, so the log cannot change under
+                # us here. Readers in this process keep going while the fsync
+                # runs; one that replays too early just stops short of the
+                # batch's commit record.
+                fd = os.open(self.wal_path, os.O_WRONLY | os.O_APPEND)
+                try:
+                    os.write(fd, b"".join(records))
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                with self._mutex:
+                    self._replay()
+
+    def iter_accounts(self):
+        with self._mutex:
+            self.refresh()
+            items = list(self.accounts.items())
+        yield from items
+
+    def stats(self):
+        with self._mutex:
+            self.refresh()
+            return {
+                "supply": self.supply,
+                "accounts": len(self.accounts),
+                "histogram": dict(self.histogram)
+            }
+
+    def wal_size(self):
+        with self._mutex:
+            return self._offset
+
+    def compact(self):
+        """Fold the log into a new snapshot. Returns False if nothing changed.
+
+        Only one process compacts at a time; the others return False straight
+        away instead of writing a second snapshot alongside.
+        """
+        try:
+            with self.compact_lock:
+                return self._compact()
+        except Timeout:
+            return False
+
+    def start_compactor(self, interval=60, max_wal_bytes=16 * 1024 * 1024):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.wal_size() > max_wal_bytes:
+                        with metrics.timed("compact"):
+                            self.compact()
+                except Exception as e:
+                    logger.error("Ledger compaction failed: " + str(e))
+
+        def restart():
+            # A worker forked from a preloaded app inherits neither the
+            # thread nor usable locks, and its copy of the log handle
+            # shares a file position with the parent, so start afresh.
+            self.lock = FileLock(self.lock.lock_file, timeout=self.lock.timeout)
+            self.compact_lock = FileLock(self.compact_lock.lock_file, timeout=0)
+            self._mutex = threading.RLock()
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+            threading.Thread(target=run, name="ledger-compactor", daemon=True).start()
+
+        thread = threading.Thread(target=run, name="ledger-compactor", daemon=True)
+        thread.start()
+        os.register_at_fork(after_in_child=restart)
+        return thread
+
+    def start_background(self):
+        self.start_compactor()
+
+    def import_json(self, json_path):
+        with self.lock:
+            if self.exists():
+                raise LedgerError(f"{self.wal_path} already exists, refusing to overwrite it.")
+
+            with open(json_path, "r") as f:
+                accounts = json.load(f)
+
+            temp_path = self.snapshot_path + ".tmp"
+            with open(temp_path, "w") as f:
+                supply, histogram = count_stats(accounts)
+                json.dump(snapshot_data(1, 0, accounts, supply, histogram), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            self.open()
+        logger.info(f"Imported {len(accounts)} accounts from {json_path} into {self.snapshot_path}.")
+        return len(accounts)
+
+    def _compact(self):
+        with self.lock:
+            with self._mutex:
+                self.refresh()
+                if self._wal is None:
+                    return False
+                if self._stale_wal:
+                    self._roll_wal(self._committed_tail())
+                generation = self.generation
+                offset = self._offset
+                accounts = dict(self.accounts)
+                supply = self.supply
+                histogram = dict(self.histogram)
+
+        # Serializing the snapshot is the slow part, so do it without the lock
+        # and only copy over what was appended in the meantime.
+        temp_snapshot = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(temp_snapshot, "w") as f:
+            json.dump(snapshot_data(generation + 1, offset, accounts, supply, histogram), f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self.lock:
+            with self._mutex:
+                self.refresh()
+                if self.generation != generation or self._stale_wal:
+                    os.remove(temp_snapshot)
+                    return False
+                self._wal.seek(offset)
+                tail = self._wal.read(self._offset - offset)
+                os.replace(temp_snapshot, self.snapshot_path)
+                fsync_directory(self.snapshot_path)
+                self._roll_wal(tail, generation + 1)
+        logger.info(f"Ledger compacted into generation {generation + 1}.")
+        return True
+
+    def _reload(self):
+        for attempt in range(10):
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, "r") as f:
+                    snapshot = json.load(f)
+            else:
+                snapshot = snapshot_data(0, 0, {}, 0, {})
+
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+
+            self.accounts = snapshot["accounts"]
+            if "supply" in snapshot:
+                self.supply = snapshot["supply"]
+                self.histogram = {int(bucket): count for bucket, count in snapshot["histogram"].items()}
+            else:
+                self.supply, self.histogram = count_stats(self.accounts)
+            self.generation = snapshot["generation"]
+            self._previous_offset = snapshot.get("previous_offset", 0)
+            self._stale_wal = False
+            self._offset = 0
+
+            try:
+                self._wal = open(self.wal_path, "rb")
+            except FileNotFoundError:
+                return
+
+            header = self._wal.read(RECORD.size)
+            record = unpack_record(header) if len(header) == RECORD.size else None
+            if record is None or record[0] != OP_HEADER:
+                raise LedgerError(f"{self.wal_path} has a corrupt header.")
+
+            wal_generation = record[3]
+            if wal_generation == self.generation:
+                self._offset = RECORD.size
+            elif wal_generation == self.generation - 1:
+                # A compaction wrote the snapshot but died before swapping in
+                # the new log. Everything past the snapshot point still counts.
+                self._offset = self._previous_offset
+                self._stale_wal = True
+            else:
+                # A compaction finished between reading the snapshot and
+                # opening the log; start over with the new pair.
+                continue
+
+            self._replay()
+            return
+        raise LedgerError(f"{self.wal_path} does not belong to {self.snapshot_path}.")
+
+    def _replay(self):
+        self._wal.seek(self._offset)
+        pending = []
+        while True:
+            data = self._wal.read(RECORD.size)
+            if len(data) < RECORD.size:
+                break
+            record = unpack_record(data)
+            if record is None:
+                break
+            pending.append(record)
+            if record[1] & FLAG_COMMIT:
+                for op, flags, username, balance, password in pending:
+                    before = self.accounts.get(username)
+                    if op == OP_PUT:
+                        after = {"password": password, "balance": balance}
+                        self.accounts[username] = after
+                    elif op == OP_DELETE:
+                        after = None
+                        self.accounts.pop(username, None)
+                    self._account_changed(before, after)
+                self._offset += len(pending) * RECORD.size
+                pending = []
+
+    def _account_changed(self, before, after):
+        if before is not None:
+            self.supply -= before["balance"]
+            bucket = balance_bucket(before["balance"])
+            self.histogram[bucket] -= 1
+            if not self.histogram[bucket]:
+                del self.histogram[bucket]
+        if after is not None:
+            self.supply += after["balance"]
+            bucket = balance_bucket(after["balance"])
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def _committed_tail(self):
+        if self._wal is None:
+            return b""
+        start = self._previous_offset if self._stale_wal else RECORD.size
+        self._wal.seek(start)
+        return self._wal.read(self._offset - start)
+
+    def _roll_wal(self, tail, generation=None):
+        if generation is None:
+            generation = self.generation
+        temp_path = self.wal_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(pack_record(OP_HEADER, FLAG_COMMIT, balance=generation))
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.wal_path)
+        fsync_directory(self.wal_path)
+        self._reload()
+
+
+def import_json(json_path, path, lock=None):
+    return Ledger(path, lock).import_json(json_path)
+
+
+def verify(path):
+    """Check the running supply and histogram against a full recount."""
+    ledger = Ledger(path)
+    ledger.refresh()
+    supply, histogram = count_stats(ledger.accounts)
+    ok = True
+    if supply != ledger.supply:
+        logger.error(f"Running supply is {ledger.supply} but the accounts add up to {supply}.")
+        ok = False
+    if histogram != ledger.histogram:
+        logger.error(f"Running balance histogram {ledger.histogram} does not match the recount {histogram}.")
+        ok = False
+    if ok:
+        logger.info(f"Supply of {supply} across {len(ledger.accounts)} accounts verified.")
+    return ok
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) >= 3 and sys.argv[1] == "import":
+        import_json(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "equacks_database")
+    elif len(sys.argv) >= 2 and sys.argv[1] == "compact":
+        Ledger(sys.argv[2] if len(sys.argv) > 2 else "equacks_database").compact()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "verify":
+        sys.exit(0 if verify(sys.argv[2] if len(sys.argv) > 2 else "equacks_database") else 1)
+    else:
+        print("Usage: python ledger.py import <equacks_database.json> [ledger path]")
+        print("       python ledger.py compact [ledger path]")
+        print("       python ledger.py verify [ledger path]")
+        sys.exit(1)
@@ -0,0 +1,57 @@
+"""Per-account locks shared by every worker process.
+
+Each username hashes onto one of a fixed number of lock files, so unrelated
+accounts almost never contend while the number of files stays bounded. The
+locks are ``FileLock``s (``flock`` on Linux), which exclude both threads of
+one worker and separate gunicorn workers on the same host, as long as they
+all point at the same lock directory. ``flock`` is not reliable over NFS, so
+every worker serving one ledger must run on the machine that holds its files.
+
+When a request needs several accounts, their stripes are taken in ascending
+order, so two transfers going opposite ways between the same pair of accounts
+cannot deadlock.
+
+A ``FileLock`` must not be used on both sides of a fork, so a worker forked
+from a preloaded app builds its own set.
+"""
+from contextlib import ExitStack, contextmanager
+from filelock import FileLock, Timeout
+import os
+import time
+import zlib
+import metrics
+
+
+class AccountLocks:
+    def __init__(self, directory, stripes=256, timeout=-1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.stripes = stripes
+        self.timeout = timeout
+        self._open_locks()
+        os.register_at_fork(after_in_child=self._open_locks)
+
+    def _open_locks(self):
+        self.locks = [FileLock(os.path.join(self.directory, f"{index:03d}.lock"), timeout=self.timeout) for index in range(self.stripes)]
+
+    def stripe(self, username):
+        # hash() is salted per process, so it cannot be used to agree on a
+        # lock file across workers.
+        return zlib.crc32(username.encode("utf-8")) % len(self.locks)
+
+    @contextmanager
+    def hold(self, *usernames):
+        with ExitStack() as stack:
+            start = time.perf_counter()
+            try:
+                for index in sorted({self.stripe(username) for username in usernames}):
+                    stack.enter_context(self.locks[index])
+            except Timeout:
+                metrics.increment("lock_timeout")
+                raise
+            acquired = time.perf_counter()
+            metrics.observe("lock_wait", acquired - start)
+            try:
+                yield
+            finally:
+                metrics.observe("lock_hold", time.perf_counter() - acquired)
@@ -0,0 +1,190 @@
+"""Durable outbox for transaction receipts.
+
+Receipts are appended to a local file as JSON lines and acknowledged once the
+records service has stored them, so a slow or unreachable records server never
+holds up a transfer. Receipt IDs are chosen here, which lets the user get their
+receipt link straight away and makes resubmitting a batch harmless.
+
+One background worker per process drains the file in batches, but only the
+worker holding the drain lock sends anything, so several gunicorn workers do
+not submit the same receipts in parallel. Lines that cannot be decoded, such
+as a torn append left by a crash, are copied to ``<path>.rejected`` and
+skipped rather than holding up everything queued behind them.
+"""
+from filelock import FileLock, Timeout
+import json
+import os
+import random
+import secrets
+import threading
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    def __init__(self, path, client, password, endpoint="/submit_records", batch_size=100):
+        self.path = path
+        self.acked_path = path + ".acked"
+        self.client = client
+        self.endpoint = endpoint
+        self.password = password
+        self.batch_size = batch_size
+        self._open_locks()
+
+    def new_id(self):
+        return secrets.token_urlsafe(32)
+
+    def submit(self, record, receipt_id=None):
+        return self.submit_many([record], None if receipt_id is None else [receipt_id])[0]
+
+    def submit_many(self, records, ids=None):
+        if ids is None:
+            ids = [self.new_id() for record in records]
+        entries = [{"id": receipt_id, "record": record} for receipt_id, record in zip(ids, records)]
+        data = "".join(json.dumps(entry) + "\n" for entry in entries).encode("utf-8")
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._wakeup.set()
+        return [entry["id"] for entry in entries]
+
+    def pending(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) - self._read_acked()
+
+    def drain(self):
+        """Send everything queued so far. Returns False if a batch failed."""
+        try:
+            with self.drain_lock:
+                while True:
+                    acked = self._read_acked()
+                    entries, end = self._read_batch(acked)
+                    if not entries:
+                        self._truncate_if_drained()
+                        return True
+
+                    # Receipt IDs make a resent batch harmless, so it is safe
+                    # to retry.
+                    with metrics.timed("upstream_http"):
+                        response = self.client.post(
+                            self.endpoint,
+                            idempotent=True,
+                            json={"password": self.password, "records": entries}
+                        )
+                    if response.status_code != 200:
+                        metrics.increment("receipt_failure", len(entries))
+                        logger.error(f"Receipt batch of {len(entries)} was rejected with {response.status_code}: {response.text}")
+                        return False
+                    self._write_acked(end)
+                    rejected = response.json().get("rejected", {})
+                    if rejected:
+                        metrics.increment("receipt_failure", len(rejected))
+                    for receipt_id, reason in rejected.items():
+                        logger.error(f"Receipt '{receipt_id}' was rejected because '{reason}'.")
+                    logger.info(f"Submitted {len(entries) - len(rejected)} receipts.")
+        except Timeout:
+            # Another worker is draining.
+            return True
+        except OSError as e:
+            # Covers everything requests raises and an open circuit.
+            metrics.increment("receipt_failure")
+            logger.error("Receipt batch could not be sent: " + str(e))
+            return False
+
+    def start_worker(self, interval=1, max_backoff=300):
+        def run():
+            backoff = interval
+            while True:
+                self._wakeup.wait(backoff)
+                self._wakeup.clear()
+                try:
+                    ok = self.drain()
+                except Exception as e:
+                    logger.error("Receipt worker failed: " + str(e))
+                    ok = False
+                if ok:
+                    backoff = interval
+                else:
+                    backoff = min(backoff * 2, max_backoff) * random.uniform(0.5, 1)
+
+        def restart():
+            # A worker forked from a preloaded app does not inherit the
+            # thread, so it starts its own, with locks of its own too.
+            self._open_locks()
+            threading.Thread(target=run, name="receipt-outbox", daemon=True).start()
+
+        thread = threading.Thread(target=run, name="receipt-outbox", daemon=True)
+        thread.start()
+        os.register_at_fork(after_in_child=restart)
+        return thread
+
+    def _open_locks(self):
+        self.lock = FileLock(self.path + ".lock")
+        self.drain_lock = FileLock(self.path + ".drain.lock", timeout=0)
+        self._wakeup = threading.Event()
+
+    def _read_batch(self, offset):
+        if not os.path.exists(self.path):
+            return [], offset
+        entries = []
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while len(entries) < self.batch_size:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    if entries:
+                        # Send what came before; the bad line starts the next batch.
+                        break
+                    offset = self._skip_bad_line(line, offset)
+                    f.seek(offset)
+                    continue
+                offset += len(line)
+        return entries, offset
+
+    def _skip_bad_line(self, line, offset):
+        # A writer that died mid-append leaves a torn entry, and the next
+        # append carries on from the same line. Receipts are serialized with
+        # json.dumps, so a later entry on the line starts with '{"id": '
+        # (quotes inside a record are escaped) and is kept.
+        start = line.find(b'{"id": ', 1)
+        skip = start if start > 0 else len(line)
+        with open(self.path + ".rejected", "ab") as f:
+            f.write(line[:skip].rstrip(b"\n") + b"\n")
+        metrics.increment("receipt_failure")
+        logger.error(f"Skipped {skip} undecodable bytes at offset {offset} of {self.path}, kept in {self.path}.rejected.")
+        self._write_acked(offset + skip)
+        return offset + skip
+
+    def _read_acked(self):
+        try:
+            with open(self.acked_path, "r") as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_acked(self, offset):
+        temp_path = self.acked_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.acked_path)
+
+    def _truncate_if_drained(self):
+        with self.lock:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0 and os.path.getsize(self.path) == self._read_acked():
+                # Reset the mark first: if we die in between, the worst case
+                # is resending receipts the records service already has.
+                self._write_acked(0)
+                os.truncate(self.path, 0)
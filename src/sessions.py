@@ -0,0 +1,77 @@
+"""Short-lived HMAC-signed session tokens.
+
+A token is ``<expiry>.<fingerprint>.<signature>``. The signature covers the
+username, the expiry and a fingerprint of the account's password hash. Checking
+a token is one HMAC and a comparison against the in-memory account, with no
+argon2 work and no database read. Because the fingerprint changes whenever the
+password hash does, changing the password or deleting and re-creating the
+account revokes every token issued before.
+
+Workers have to agree on the key. It comes from the ``session_secret``
+environment variable, or from a key file created by whichever worker starts
+first.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+
+def load_secret(path):
+    secret = os.environ.get("session_secret")
+    if secret:
+        return secret.encode("utf-8")
+    if not os.path.exists(path):
+        # Link a fully written file into place so a worker starting at the
+        # same moment either loses the race or reads the whole key.
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secrets.token_bytes(32))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def fingerprint(password_hash):
+    return hashlib.sha256(password_hash.encode("utf-8")).hexdigest()[:16]
+
+
+class SessionSigner:
+    def __init__(self, secret, lifetime=3600):
+        self.secret = secret
+        self.lifetime = lifetime
+
+    def issue(self, username, password_hash):
+        expiry = int(time.time()) + self.lifetime
+        payload = f"{expiry}.{fingerprint(password_hash)}"
+        return payload + "." + self._sign(username, payload), expiry
+
+    def check(self, token, username, password_hash):
+        # compare_digest refuses non-ASCII str, and isdigit() accepts
+        # characters such as "²" that int() does not, so only real tokens
+        # get any further.
+        if not token.isascii():
+            return False
+        parts = token.split(".")
+        if len(parts) != 3 or not parts[0].isdigit():
+            return False
+        payload = parts[0] + "." + parts[1]
+        if not hmac.compare_digest(parts[2], self._sign(username, payload)):
+            return False
+        if int(parts[0]) < time.time():
+            return False
+        return hmac.compare_digest(parts[1], fingerprint(password_hash))
+
+    def _sign(self, username, payload):
+        digest = hmac.new(self.secret, (username + "\n" + payload).encode("utf-8"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
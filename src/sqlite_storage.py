@@ -0,0 +1,248 @@
+"""Account storage in a SQLite database running in WAL mode.
+
+Every thread gets its own connection. In WAL mode readers work from a
+snapshot and never wait on the writer, so ``get_balance`` and
+``total_supply`` keep answering while a transfer commits. Writers take
+SQLite's single write slot with ``BEGIN IMMEDIATE``, which also covers
+gunicorn workers in other processes on the same host.
+
+Running totals live next to the accounts and are updated in the same
+transaction as the balances they describe:
+
+- ``accounts``: one row per user, keyed on the username.
+- ``totals``: a single row with the supply and the number of accounts.
+- ``balance_histogram``: how many accounts fall into each balance bucket,
+  bucketed the same way as the ledger.
+
+Move an existing database over with one of
+
+    python sqlite_storage.py import equacks_database.json
+    python sqlite_storage.py import-ledger equacks_database
+
+and check the totals against a full recount with ``python sqlite_storage.py
+verify``.
+"""
+from filelock import FileLock
+import os
+import sqlite3
+import sys
+import threading
+import time
+import logging
+import metrics
+from ledger import Ledger, balance_bucket, count_stats
+from storage import Storage
+from streaming import iter_object
+
+logger = logging.getLogger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS accounts (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    balance INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    supply INTEGER NOT NULL,
+    accounts INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS balance_histogram (
+    bucket INTEGER PRIMARY KEY,
+    accounts INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals (id, supply, accounts) VALUES (1, 0, 0);
+"""
+
+
+class SQLiteStorageError(Exception):
+    pass
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path, lock=None, timeout=30):
+        self.path = path
+        self.lock = lock if lock is not None else FileLock(path + ".lock")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connection(self):
+        # A connection must not be carried across a fork, so remember which
+        # process opened it.
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA synchronous = FULL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def open(self):
+        """Create the schema if needed. The caller must hold ``self.lock``."""
+        connection = self.connection()
+        if connection.execute("PRAGMA journal_mode = WAL").fetchone()[0] != "wal":
+            raise SQLiteStorageError(f"{self.path} could not be switched to WAL mode.")
+        connection.executescript(schema)
+
+    def get(self, username):
+        with metrics.timed("db_load"):
+            row = self.connection().execute("SELECT password, balance FROM accounts WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        return {"password": row[0], "balance": row[1]}
+
+    def commit(self, changes):
+        """Apply ``changes``, a list of ``(username, account)`` pairs, in one transaction.
+
+        ``account`` is a ``{"password": ..., "balance": ...}`` dict, or None to
+        delete the user. Callers must make sure nobody else changes the same
+        accounts between reading them and committing.
+        """
+        if not changes:
+            return
+        connection = self.connection()
+        start = time.perf_counter()
+        connection.execute("BEGIN IMMEDIATE")
+        metrics.observe("write_lock_wait", time.perf_counter() - start)
+        try:
+            with metrics.timed("db_write"):
+                for username, account in changes:
+                    row = connection.execute("SELECT balance FROM accounts WHERE username = ?", (username,)).fetchone()
+                    if row is not None:
+                        self._count(connection, -row[0], -1)
+                    if account is None:
+                        connection.execute("DELETE FROM accounts WHERE username = ?", (username,))
+                    else:
+                        connection.execute(
+                            "INSERT OR REPLACE INTO accounts (username, password, balance) VALUES (?, ?, ?)",
+                            (username, account["password"], account["balance"])
+                        )
+                        self._count(connection, account["balance"], 1)
+                connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def iter_accounts(self):
+        # A connection of its own, so a slow consumer keeps its read snapshot
+        # without tying up the connection this thread uses for requests.
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            connection.execute("BEGIN")
+            for username, password, balance in connection.execute("SELECT username, password, balance FROM accounts"):
+                yield username, {"password": password, "balance": balance}
+        finally:
+            connection.close()
+
+    def stats(self):
+        connection = self.connection()
+        with metrics.timed("db_load"):
+            # One read transaction, so the totals and the histogram agree.
+            connection.execute("BEGIN")
+            try:
+                supply, accounts = connection.execute("SELECT supply, accounts FROM totals WHERE id = 1").fetchone()
+                histogram = dict(connection.execute("SELECT bucket, accounts FROM balance_histogram"))
+            finally:
+                connection.execute("COMMIT")
+        return {"supply": supply, "accounts": accounts, "histogram": histogram}
+
+    def warm_up(self):
+        # Counting walks the whole accounts table, which pulls its pages into
+        # the OS cache instead of leaving each first lookup to wait on disk.
+        self.connection().execute("SELECT count(*) FROM accounts").fetchone()
+        self.stats()
+
+    def import_json(self, json_path):
+        with open(json_path, "r", encoding="utf-8") as f:
+            return self.import_accounts(iter_object(f), json_path)
+
+    def import_accounts(self, accounts, source):
+        """Import ``(username, account)`` pairs, or a dict of them."""
+        with self.lock:
+            if self.exists():
+                raise SQLiteStorageError(f"{self.path} already exists, refusing to overwrite it.")
+
+            # Build the database under a temporary name, so a failed import
+            # does not leave an empty store behind that looks finished.
+            temp = SQLiteStorage(self.path + ".tmp", self.lock)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(temp.path + suffix):
+                    os.remove(temp.path + suffix)
+            temp.open()
+            if isinstance(accounts, dict):
+                accounts = accounts.items()
+            totals = {"supply": 0, "accounts": 0}
+            histogram = {}
+
+            def rows():
+                for username, account in accounts:
+                    totals["supply"] += account["balance"]
+                    totals["accounts"] += 1
+                    bucket = balance_bucket(account["balance"])
+                    histogram[bucket] = histogram.get(bucket, 0) + 1
+                    yield username, account["password"], account["balance"]
+
+            connection = temp.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany("INSERT INTO accounts (username, password, balance) VALUES (?, ?, ?)", rows())
+                connection.execute("UPDATE totals SET supply = ?, accounts = ? WHERE id = 1", (totals["supply"], totals["accounts"]))
+                connection.executemany("INSERT INTO balance_histogram (bucket, accounts) VALUES (?, ?)", histogram.items())
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            # Closing the only connection checkpoints the log into the main
+            # file, so the database is a single file by the time it moves.
+            connection.close()
+            temp._local.connection = None
+            os.replace(temp.path, self.path)
+            self.open()
+        logger.info(f"Imported {totals['accounts']} accounts from {source} into {self.path}.")
+        return totals["accounts"]
+
+    def _count(self, connection, balance, accounts):
+        connection.execute("UPDATE totals SET supply = supply + ?, accounts = accounts + ? WHERE id = 1", (balance, accounts))
+        bucket = balance_bucket(abs(balance))
+        if connection.execute("UPDATE balance_histogram SET accounts = accounts + ? WHERE bucket = ?", (accounts, bucket)).rowcount == 0:
+            connection.execute("INSERT INTO balance_histogram (bucket, accounts) VALUES (?, ?)", (bucket, accounts))
+        connection.execute("DELETE FROM balance_histogram WHERE bucket = ? AND accounts = 0", (bucket,))
+
+
+def verify(path):
+    """Check the running totals against a full recount."""
+    storage = SQLiteStorage(path)
+    stats = storage.stats()
+    accounts = {row[0]: {"balance": row[1]} for row in storage.connection().execute("SELECT username, balance FROM accounts")}
+    supply, histogram = count_stats(accounts)
+    ok = True
+    if supply != stats["supply"] or len(accounts) != stats["accounts"]:
+        logger.error(f"Running totals say {stats['supply']} across {stats['accounts']} accounts but the recount is {supply} across {len(accounts)}.")
+        ok = False
+    if histogram != stats["histogram"]:
+        logger.error(f"Running balance histogram {stats['histogram']} does not match the recount {histogram}.")
+        ok = False
+    if ok:
+        logger.info(f"Supply of {supply} across {len(accounts)} accounts verified.")
+    return ok
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    default_path = "equacks_database.sqlite3"
+    if len(sys.argv) >= 3 and sys.argv[1] == "import":
+        SQLiteStorage(sys.argv[3] if len(sys.argv) > 3 else default_path).import_json(sys.argv[2])
+    elif len(sys.argv) >= 3 and sys.argv[1] == "import-ledger":
+        ledger = Ledger(sys.argv[2])
+        ledger.refresh()
+        SQLiteStorage(sys.argv[3] if len(sys.argv) > 3 else default_path).import_accounts(ledger.accounts, sys.argv[2])
+    elif len(sys.argv) >= 2 and sys.argv[1] == "verify":
+        sys.exit(0 if verify(sys.argv[2] if len(sys.argv) > 2 else default_path) else 1)
+    else:
+        print("Usage: python sqlite_storage.py import <equacks_database.json> [database path]")
+        print("       python sqlite_storage.py import-ledger <ledger path> [database path]")
+        print("       python sqlite_storage.py verify [database path]")
+        sys.exit(1)
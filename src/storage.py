@@ -0,0 +1,72 @@
+"""The account storage interface the API is written against.
+
+Pick a backend with the ``equacks_storage`` environment variable:
+
+- ``ledger`` (default): the append-only log with an in-memory index in
+  ledger.py.
+- ``sqlite``: a SQLite database in WAL mode, see sqlite_storage.py.
+
+Both keep account rows in the same ``{"password": ..., "balance": ...}`` shape
+as the old JSON database and keep the supply counters up to date on every
+commit. Neither does its own account-level locking, so callers still take
+``AccountLocks`` around read-check-commit sequences.
+"""
+import os
+
+
+class Storage:
+    def open(self):
+        """Create the store if needed and load it. Call once per process."""
+        raise NotImplementedError
+
+    def get(self, username):
+        """Return the account dict for ``username``, or None."""
+        raise NotImplementedError
+
+    def commit(self, changes):
+        """Atomically apply ``(username, account or None)`` pairs."""
+        raise NotImplementedError
+
+    def iter_accounts(self):
+        """Yield every ``(username, account)`` pair, in no particular order."""
+        raise NotImplementedError
+
+    def stats(self):
+        """Return ``{"supply", "accounts", "histogram"}`` without a full scan."""
+        raise NotImplementedError
+
+    def start_background(self):
+        """Start any maintenance threads the backend needs."""
+
+    def warm_up(self):
+        """Read in whatever the first requests would otherwise wait on disk for."""
+
+    def exists(self):
+        """Whether the store has been created on disk yet."""
+        raise NotImplementedError
+
+    def import_json(self, json_path):
+        """Fill a store that does not exist yet from an old JSON database."""
+        raise NotImplementedError
+
+
+def make_storage(kind, path, lock=None):
+    """Return the backend called ``kind`` without opening or creating it."""
+    if kind == "ledger":
+        from ledger import Ledger
+        return Ledger(path, lock)
+    if kind == "sqlite":
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(path + ".sqlite3", lock)
+    raise ValueError(f"Unknown storage backend '{kind}'.")
+
+
+def open_storage(kind, path, legacy_path=None, lock=None):
+    """Open the backend called ``kind``, importing ``legacy_path`` on first run."""
+    storage = make_storage(kind, path, lock)
+    with storage.lock:
+        if not storage.exists() and legacy_path is not None and os.path.exists(legacy_path):
+            storage.import_json(legacy_path)
+        storage.open()
+    storage.start_background()
+    return storage
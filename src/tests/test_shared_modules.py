@@ -0,0 +1,38 @@
+"""Modules copied between services must stay identical.
+
+Each service is deployed on its own and imports its modules by bare name, so
+the shared ones are kept as copies rather than imported from one place.
+"""
+import os
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+shared = {
+    "ratelimit.py": ["src", "records", "faucet"],
+    "metrics.py": ["src", "records", "faucet"],
+    "streaming.py": ["src", "records"],
+    "http_client.py": ["src", "faucet"],
+}
+
+
+@pytest.mark.parametrize("name", sorted(shared))
+def test_copies_match(name):
+    contents = {}
+    for service in shared[name]:
+        with open(os.path.join(root, service, name), "rb") as f:
+            contents[service] = f.read()
+    first = shared[name][0]
+    different = [service for service, data in contents.items() if data != contents[first]]
+    assert not different, f"{name} in {', '.join(different)} differs from the copy in {first}/."
+
+
+def test_every_copy_is_checked():
+    # A module that says it is copied must be listed above.
+    for service in ("src", "records", "faucet"):
+        for name in os.listdir(os.path.join(root, service)):
+            if not name.endswith(".py"):
+                continue
+            with open(os.path.join(root, service, name), "r", encoding="utf-8") as f:
+                if "keep the copies in sync" in " ".join(f.read().split()):
+                    assert service in shared.get(name, []), f"{service}/{name} is a copy but is not checked."
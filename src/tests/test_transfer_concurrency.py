@@ -0,0 +1,94 @@
+"""Random transfers through /transfer_currency from several workers must conserve supply."""
+import collections
+import multiprocessing
+import os
+import random
+import threading
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("argon2")
+
+from argon2 import PasswordHasher
+from ledger import count_stats
+
+ACCOUNTS = 20
+STARTING_BALANCE = 100
+PROCESSES = 4
+THREADS = 4
+TRANSFERS = 25
+PASSWORD = "password"
+USERNAMES = [f"user{index}" for index in range(ACCOUNTS)]
+
+
+def transfer_randomly(seed):
+    # Runs in a forked worker, against the app its parent preloaded.
+    import api
+
+    statuses = collections.Counter()
+    errors = []
+
+    def run(rng):
+        try:
+            client = api.app.test_client()
+            for _ in range(TRANSFERS):
+                sender, receiver = rng.sample(USERNAMES, 2)
+                response = client.post("/transfer_currency", data={
+                    "username": sender,
+                    "password": PASSWORD,
+                    "receiver": receiver,
+                    "amount": str(rng.randint(1, 60))
+                })
+                statuses[response.status_code] += 1
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(random.Random(seed * THREADS + index),)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return statuses
+
+
+def run_bank(kind, directory, results):
+    # Plays the part of a gunicorn master started with --preload: import the
+    # app once, then fork the workers. It runs in a process of its own since
+    # the app keeps its files relative to the working directory.
+    os.chdir(directory)
+    os.environ.update({"equacks_storage": kind, "warm_up": "0", "records_url": "http://127.0.0.1:9"})
+    import api
+
+    # The cheapest argon2 settings, so the test spends its time on locking.
+    api.ph = PasswordHasher(time_cost=1, memory_cost=8, parallelism=1)
+    api.limiter.enabled = False
+    hashed_password = api.ph.hash(PASSWORD)
+    api.storage.commit([(username, {"password": hashed_password, "balance": STARTING_BALANCE}) for username in USERNAMES])
+
+    with multiprocessing.get_context("fork").Pool(PROCESSES) as pool:
+        statuses = sum(pool.map_async(transfer_randomly, range(PROCESSES), chunksize=1).get(300), collections.Counter())
+    results.put((statuses, dict(api.storage.iter_accounts()), api.storage.stats()))
+
+
+@pytest.mark.parametrize("kind", ["ledger", "sqlite"])
+def test_random_transfers_conserve_supply(kind, tmp_path):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    bank = context.Process(target=run_bank, args=(kind, str(tmp_path), results))
+    bank.start()
+    statuses, accounts, stats = results.get(timeout=300)
+    bank.join()
+
+    # 400 is "not enough currency"; anything else is a failure.
+    assert set(statuses) <= {200, 400}
+    assert statuses[200] > 0
+    assert sum(statuses.values()) == PROCESSES * THREADS * TRANSFERS
+
+    supply, histogram = count_stats(accounts)
+    assert supply == ACCOUNTS * STARTING_BALANCE
+    assert stats["supply"] == supply
+    assert stats["accounts"] == len(accounts) == ACCOUNTS
+    assert stats["histogram"] == histogram
+    assert all(account["balance"] >= 0 for account in accounts.values())